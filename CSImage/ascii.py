@@ -1,49 +1,140 @@
 import shutil
 import time
-import zlib
 
+from functools import cache
 from io import BytesIO
-from PIL import Image
-from rich.align import Align
-from rich.live import Live
-from rich.table import Table
+from threading import Thread
 
-from search import process
+import metrics
+import watch
 
+from search import FrameBuffer, process
+from thumbnails import ThumbnailCache
 
-def main(cwd):
-    processed, matches = 0, 0
+
+CHARS = ['B', 'S', '#', '&', '@', '$', '%', '*', '!', ':', '.']
+COLOUR_STEP = 16
+FPS = 30
+MATCH_HOLD = .25  # Seconds a match stays on screen
+
+# PIL, rich and NumPy are imported where they are first used, so the
+# module, and --help, load without them
+
+
+@cache
+def numpy():
+    """Returns a tuple of the numpy module and CHAR_LUT, the character of
+    every greyscale value, else (None, None) if NumPy isn't installed
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return None, None
+    return np, np.frombuffer(
+        ''.join(CHARS[pixel // 25] for pixel in range(256)).encode('ascii'),
+        dtype=np.uint8
+    )
+
+
+def main(
+    cwd,
+    index_path=None,
+    max_distance=None,
+    fps=FPS,
+    thumbnails=None,
+    watching=False
+):
+    """Scans cwd on a background thread and renders the results at no more
+    than fps frames per second. Frames the renderer can't keep up with are
+    skipped, matches are shown for MATCH_HOLD seconds without pausing the
+    scan and the status counters always include every result. Previews are
+    made from thumbnails, a ThumbnailCache, if given. With watching, cwd is
+    watched for new images once it has been scanned, see watch.watch.
+    """
+    from rich.live import Live
+
+    if max_distance is None:
+        results = (watch.process if watching else process)(
+            cwd, index_path=index_path
+        )
+    else:
+        import perceptual
+
+        results = perceptual.process(cwd, max_distance=max_distance)
+    frames = FrameBuffer()
+    counts = {'processed': 0, 'matches': 0}
+    error = []
+    scanner = Thread(
+        target=scan, args=(results, frames, counts, error), daemon=True
+    )
+    frame_seconds = 1 / fps
+    img, is_match, hold_until = None, False, 0
     with Live(generate_table(), auto_refresh=False, screen=True) as live:
-        for is_match, fpath, mem in process(cwd):
-            height, width = shutil.get_terminal_size()
-            height -= 50
-            if is_match:
-                matches += 1
-                height = height // 2
-                width = width // 2
-            processed += 1
-            if img := convert(mem, term_width=width, term_height=height):
+        scanner.start()
+        while scanner.is_alive() or frames:
+            tick = time.perf_counter()
+            if tick >= hold_until and (frame := frames.get()) is not None:
+                frame_match, _, mem = frame
+                height, width = shutil.get_terminal_size()
+                height -= 50
+                if frame_match:
+                    height = height // 2
+                    width = width // 2
+                if thumbnails is not None:
+                    mem = thumbnails.preview(mem, (width, height))
+                try:
+                    frame_img = convert(
+                        mem, term_width=width, term_height=height
+                    )
+                except OSError:
+                    frame_img = None  # Not an image PIL can decode
+                if frame_img:
+                    img, is_match = frame_img, frame_match
+                    if is_match:
+                        hold_until = tick + MATCH_HOLD
+            if img:
                 live.update(
                     generate_table(
                         img=img,
-                        processed=processed,
-                        matches=matches,
+                        processed=counts['processed'],
+                        matches=counts['matches'],
                         is_match=is_match
                     )
                 )
                 live.refresh()
-                if is_match:
-                    time.sleep(.25)
+            time.sleep(max(frame_seconds - (time.perf_counter() - tick), 0))
+        scanner.join()
+        if error:
+            raise error[0]
         live.update(
             generate_results_table(
-                cwd=cwd, processed=processed, matches=matches
+                cwd=cwd,
+                processed=counts['processed'],
+                matches=counts['matches']
             )
         )
         live.refresh()
         live.update(input())
 
 
+def scan(results, frames, counts, error):
+    """Consumes the scan results, updating counts and offering every result
+    to the FrameBuffer. Any exception is stored in error for main to raise.
+    """
+    try:
+        for result in results:
+            if result[0]:
+                counts['matches'] += 1
+            counts['processed'] += 1
+            frames.put(result)
+    except Exception as e:
+        error.append(e)
+
+
 def generate_table(*, img=None, processed=None, matches=None, is_match=None):
+    from rich.align import Align
+    from rich.table import Table
+
     if img is None:
         return
     match_table = Table(show_header=False, show_footer=False, expand=True)
@@ -64,6 +155,9 @@ def generate_table(*, img=None, processed=None, matches=None, is_match=None):
 
 
 def generate_results_table(*, cwd, processed, matches):
+    from rich.align import Align
+    from rich.table import Table
+
     table = Table(show_header=False, show_footer=False)
     table.add_column()
     table.add_row(Align.center(cwd))
@@ -72,8 +166,36 @@ def generate_results_table(*, cwd, processed, matches):
     return Align(table, align='center', vertical='middle')
 
 
-def convert(mem, term_width, term_height):
-    img = Image.open(BytesIO(zlib.decompress(mem))).convert('L')  # Greyscale
+def convert(mem, term_width, term_height, colour=False):
+    """Returns the image as ASCII art sized to fit the terminal dimensions.
+
+    Uses the NumPy renderers when NumPy is installed, else the pure Python
+    ones.
+
+    Optional:
+        colour (kwarg): If True, a rich Text coloured with truecolor styles
+                        is returned instead of a str
+    """
+    if (recorder := metrics.recorder()) is not None:
+        with recorder.timer('render'):
+            return convert_image(mem, term_width, term_height, colour)
+    return convert_image(mem, term_width, term_height, colour)
+
+
+def convert_image(mem, term_width, term_height, colour):
+    from PIL import Image
+
+    img = resize(Image.open(BytesIO(mem.read())), term_width, term_height)
+    if colour:
+        if numpy()[0] is None:
+            return render_colour_python(img.convert('RGB'))
+        return render_colour(img.convert('RGB'))
+    if numpy()[0] is None:
+        return render_python(img.convert('L'))  # Greyscale
+    return render(img.convert('L'))  # Greyscale
+
+
+def resize(img, term_width, term_height):
     width, height = img.size
     aspect_ratio = height / width
     if width > term_width:
@@ -82,10 +204,24 @@ def convert(mem, term_width, term_height):
     if height > term_height:
         if (new_height := int(aspect_ratio * term_width * 0.55)) > 1:
             height = new_height
-    img = img.resize((width, height))
+    img.draft(img.mode, (width, height))  # DCT scaling for JPEGs
+    return img.resize((width, height))
+
+
+def render(img):
+    """Maps a greyscale image through CHAR_LUT in a single NumPy step and
+    joins the rows by adding a column of newlines
+    """
+    np, char_lut = numpy()
+    pixels = char_lut[np.asarray(img, dtype=np.uint8)]
+    newlines = np.full((pixels.shape[0], 1), ord('\n'), dtype=np.uint8)
+    return np.hstack((pixels, newlines)).tobytes()[:-1].decode('ascii')
+
+
+def render_python(img):
+    width = img.size[0]
     pixels = img.getdata()
-    chars = ['B', 'S', '#', '&', '@', '$', '%', '*', '!', ':', '.']
-    new_pixels = ''.join([chars[pixel // 25] for pixel in pixels])
+    new_pixels = ''.join([CHARS[pixel // 25] for pixel in pixels])
     new_pixels_count = len(new_pixels)
     ascii_image = '\n'.join(
         [
@@ -96,10 +232,127 @@ def convert(mem, term_width, term_height):
     return ascii_image
 
 
+def render_colour(img):
+    """Returns a rich Text of the RGB image where each run of characters
+    sharing a colour, quantized to COLOUR_STEP, is a single Span
+    """
+    from rich.style import Style
+    from rich.text import Span, Text
+
+    np, _ = numpy()
+    rgb = np.asarray(img, dtype=np.uint8)
+    height, width = rgb.shape[:2]
+    plain = render(img.convert('L'))
+    red, green, blue = np.moveaxis(
+        (rgb // COLOUR_STEP * COLOUR_STEP).astype(np.uint32), -1, 0
+    )
+    packed = red << 16 | green << 8 | blue
+    starts = np.ones((height, width), dtype=bool)
+    starts[:, 1:] = packed[:, 1:] != packed[:, :-1]
+    rows, cols = np.nonzero(starts)
+    offsets = rows * (width + 1) + cols  # + 1 for the newlines
+    ends = np.append(offsets[1:], len(plain))
+    ends = np.minimum(ends, rows * (width + 1) + width)
+    styles = {}
+    spans = []
+    for start, end, colour in zip(
+        offsets.tolist(), ends.tolist(), packed[rows, cols].tolist()
+    ):
+        if (style := styles.get(colour)) is None:
+            style = styles[colour] = Style(color=f'#{colour:06x}')
+        spans.append(Span(start, end, style))
+    return Text(plain, spans=spans, no_wrap=True)
+
+
+def render_colour_python(img):
+    from rich.style import Style
+    from rich.text import Span, Text
+
+    width, height = img.size
+    plain = render_python(img.convert('L'))
+    pixels = list(img.getdata())
+    styles = {}
+    spans = []
+
+    def add_span(start, end, colour):
+        if (style := styles.get(colour)) is None:
+            style = styles[colour] = Style(color=f'#{colour:06x}')
+        spans.append(Span(start, end, style))
+
+    for row in range(height):
+        offset = row * (width + 1)  # + 1 for the newlines
+        start, previous = 0, None
+        for col, (red, green, blue) in enumerate(
+            pixels[row * width:(row + 1) * width]
+        ):
+            colour = (
+                red // COLOUR_STEP * COLOUR_STEP << 16
+                | green // COLOUR_STEP * COLOUR_STEP << 8
+                | blue // COLOUR_STEP * COLOUR_STEP
+            )
+            if colour != previous:
+                if previous is not None:
+                    add_span(offset + start, offset + col, previous)
+                start, previous = col, colour
+        add_span(offset + start, offset + width, previous)
+    return Text(plain, spans=spans, no_wrap=True)
+
+
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument('cwd')
+    parser.add_argument(
+        '--index', help='Filepath of an on-disk index to reuse between scans'
+    )
+    parser.add_argument(
+        '--distance',
+        type=int,
+        help='Find near-duplicates within this perceptual hash distance'
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Filepath to write stage metrics to, as Prometheus text if it '
+             'ends with .prom else JSON'
+    )
+    parser.add_argument(
+        '--fps',
+        type=float,
+        default=FPS,
+        help='Most frames to render per second'
+    )
+    parser.add_argument(
+        '--thumbnails',
+        help='Directory of the thumbnail cache shared by the front-ends'
+    )
+    parser.add_argument(
+        '--no-thumbnails',
+        action='store_true',
+        help='Decode the original images instead of cached thumbnails'
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep watching cwd after the scan and show new images as they '
+             'are written'
+    )
     args = parser.parse_args()
-    main(args.cwd)
+    if args.fps <= 0:
+        parser.error('--fps must be greater than 0')
+    if args.watch and args.distance is not None:
+        parser.error('--distance can not be used with --watch')
+    if args.metrics:
+        metrics.enable()
+    main(
+        args.cwd,
+        index_path=args.index,
+        max_distance=args.distance,
+        fps=args.fps,
+        thumbnails=None if args.no_thumbnails else ThumbnailCache(
+            args.thumbnails
+        ),
+        watching=args.watch
+    )
+    if args.metrics:
+        metrics.current.write(args.metrics)
@@ -0,0 +1,52 @@
+import time
+
+from io import BytesIO
+from PIL import Image
+
+from ascii import convert, render, render_colour, render_python
+from search import ImageData
+
+
+def synthetic_image(width, height):
+    """Returns an ImageData object of a noisy gradient JPEG"""
+    img = Image.radial_gradient('L').resize((width, height)).convert('RGB')
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    buffer = BytesIO()
+    Image.blend(img, noise, 0.5).save(buffer, format='JPEG')
+    return ImageData(None, buffer.getvalue())
+
+
+def frames_per_second(func, *args, seconds=1.0):
+    frames = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        func(*args)
+        frames += 1
+    return frames / elapsed
+
+
+def main(term_width, term_height, seconds):
+    mem = synthetic_image(term_width * 4, term_height * 4)
+    img = Image.open(BytesIO(mem.read())).resize((term_width, term_height))
+    grey, rgb = img.convert('L'), img.convert('RGB')
+    print(f'Terminal {term_width}x{term_height}')
+    results = (
+        ('render_python', render_python, grey),
+        ('render', render, grey),
+        ('render_colour', render_colour, rgb),
+        ('convert (decode + render)', convert, mem, term_width, term_height),
+    )
+    for name, func, *args in results:
+        fps = frames_per_second(func, *args, seconds=seconds)
+        print(f'{name:>26}: {fps:10,.1f} fps')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=400)
+    parser.add_argument('--height', type=int, default=200)
+    parser.add_argument('--seconds', type=float, default=1.0)
+    args = parser.parse_args()
+    main(args.width, args.height, args.seconds)
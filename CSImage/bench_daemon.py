@@ -0,0 +1,137 @@
+import hashlib
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from multiprocessing import Event, Pool, Process
+
+from daemon import Client, Library, serve
+
+
+def digest(idx):
+    return hashlib.md5(b'%d' % idx).digest()
+
+
+def p_hash(idx):
+    return int.from_bytes(hashlib.md5(b'p%d' % idx).digest()[:8], 'big')
+
+
+def run_server(address, files, perceptual, ready):
+    """Serves a Library of files synthetic entries, every one with a
+    perceptual hash if perceptual
+    """
+    library = Library(perceptual=perceptual)
+    for idx in range(files):
+        library.add(digest(idx), f'/library/{idx:08d}.jpg')
+        if perceptual:
+            library.tree.add(p_hash(idx), f'/library/{idx:08d}.jpg')
+    serve(library, address, ready)
+
+
+def run_client(address, op, files, batch, seconds, seed):
+    """Sends requests of batch queries, half of them for entries in the
+    library, for seconds. Returns a tuple of the number of queries and the
+    seconds each request took.
+    """
+    rng = random.Random(seed)
+    latencies = []
+    queries = 0
+    with Client(address) as client:
+        end = time.perf_counter() + seconds
+        while (start := time.perf_counter()) < end:
+            if op == 'near':
+                keys = [
+                    p_hash(rng.randrange(files)) ^ (1 << rng.randrange(64))
+                    if rng.random() < .5 else rng.getrandbits(64)
+                    for _ in range(batch)
+                ]
+                client.request(op='near', phashes=keys, max_distance=4)
+            elif op == 'insert':
+                entries = [
+                    {
+                        'path': f'/inserted/{seed}-{queries + idx}.jpg',
+                        'digest': os.urandom(16).hex(),
+                    }
+                    for idx in range(batch)
+                ]
+                client.request(op='insert', entries=entries)
+            else:
+                keys = [
+                    (
+                        digest(rng.randrange(files))
+                        if rng.random() < .5 else rng.randbytes(16)
+                    ).hex()
+                    for _ in range(batch)
+                ]
+                client.request(op='lookup', digests=keys)
+            latencies.append(time.perf_counter() - start)
+            queries += batch
+    return queries, latencies
+
+
+def main(files, clients, seconds, perceptual):
+    address = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+    ready = Event()
+    server = Process(
+        target=run_server,
+        args=(address, files, perceptual, ready),
+        daemon=True
+    )
+    start = time.perf_counter()
+    server.start()
+    ready.wait()
+    print(
+        f'{files:,} files loaded in {time.perf_counter() - start:,.2f}s, '
+        f'{clients} clients for {seconds}s each'
+    )
+    print(
+        f'{"op":<8} {"batch":>6} {"queries/s":>12} '
+        f'{"p50 ms":>8} {"p99 ms":>8}'
+    )
+    runs = [('lookup', 1), ('lookup', 100), ('insert', 100)]
+    if perceptual:
+        runs += [('near', 1), ('near', 100)]
+    try:
+        with Pool(clients) as pool:
+            for op, batch in runs:
+                results = pool.starmap(
+                    run_client,
+                    [
+                        (address, op, files, batch, seconds, seed)
+                        for seed in range(clients)
+                    ]
+                )
+                queries = sum(result[0] for result in results)
+                latencies = sorted(
+                    latency for result in results for latency in result[1]
+                )
+                p50 = statistics.median(latencies)
+                p99 = latencies[int(len(latencies) * .99)]
+                print(
+                    f'{op:<8} {batch:>6} {queries / seconds:>12,.0f} '
+                    f'{p50 * 1000:>8,.3f} {p99 * 1000:>8,.3f}'
+                )
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Measures the queries per second and request latency '
+                    'of the query daemon over its Unix socket'
+    )
+    parser.add_argument('--files', type=int, default=100_000)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument(
+        '--perceptual',
+        action='store_true',
+        help='Also load random perceptual hashes and time near lookups'
+    )
+    args = parser.parse_args()
+    main(args.files, args.clients, args.seconds, args.perceptual)
@@ -0,0 +1,85 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+
+from search import ALGORITHMS, generate_hash
+
+
+def hash_readinto(fpath, algorithm, chunk_size):
+    return generate_hash(
+        fpath, previews=False, algorithm=algorithm, chunk_size=chunk_size
+    )[1]
+
+
+def hash_file_digest(fpath, algorithm, chunk_size):
+    with open(fpath, 'rb') as f:
+        return hashlib.file_digest(f, ALGORITHMS[algorithm]).digest()
+
+
+def hash_mmap(fpath, algorithm, chunk_size):
+    f_hash = ALGORITHMS[algorithm]()
+    with open(fpath, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            for offset in range(0, len(mapped), chunk_size):
+                f_hash.update(view[offset:offset + chunk_size])
+            view.release()
+    return f_hash.digest()
+
+
+def megabytes_per_second(func, fpath, algorithm, chunk_size, repeat):
+    size = os.stat(fpath).st_size * repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(fpath, algorithm, chunk_size)
+    return size / (time.perf_counter() - start) / 1024 / 1024
+
+
+def main(fpath, chunk_sizes, repeat):
+    methods = (
+        ('readinto', hash_readinto),
+        ('file_digest', hash_file_digest),
+        ('mmap', hash_mmap),
+    )
+    print(f'{fpath} ({os.stat(fpath).st_size:,} bytes x {repeat})')
+    print(f'{"algorithm":>10} {"method":>12} {"chunk":>10} {"MB/s":>10}')
+    for algorithm in ALGORITHMS:
+        for name, func in methods:
+            # file_digest picks its own buffer size
+            sizes = chunk_sizes[:1] if name == 'file_digest' else chunk_sizes
+            for chunk_size in sizes:
+                speed = megabytes_per_second(
+                    func, fpath, algorithm, chunk_size, repeat
+                )
+                print(
+                    f'{algorithm:>10} {name:>12} {chunk_size:>10,} '
+                    f'{speed:>10,.1f}'
+                )
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'fpath',
+        nargs='?',
+        help='File to hash. A random 64 MiB file is used if not given'
+    )
+    parser.add_argument(
+        '--chunk-sizes',
+        type=int,
+        nargs='+',
+        default=[8 * 1024, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if args.fpath is None:
+        with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+            f.write(os.urandom(64 * 1024 * 1024))
+            f.flush()
+            main(f.name, args.chunk_sizes, args.repeat)
+    else:
+        main(args.fpath, args.chunk_sizes, args.repeat)
@@ -0,0 +1,109 @@
+import os
+import tempfile
+import time
+
+from io import BytesIO
+from PIL import Image
+
+from search import make_preview, process
+
+
+def synthetic_photo(fpath, width, height):
+    """Writes a noisy gradient JPEG, which decodes about as slowly as a
+    photo of the same size
+    """
+    img = Image.radial_gradient('L').resize((width, height)).convert('RGB')
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    Image.blend(img, noise, 0.5).save(fpath, quality=90)
+
+
+def full_decode(data, preview_size):
+    """What the front-ends do without previews, decode then downscale"""
+    img = Image.open(BytesIO(data))
+    img.load()
+    img.thumbnail(preview_size, reducing_gap=None)
+    return img
+
+
+def preview_decode(data, preview_size):
+    img = Image.open(BytesIO(make_preview(data, preview_size)))
+    img.load()
+    return img
+
+
+def per_image(fpath, preview_size, repeat):
+    with open(fpath, 'rb') as f:
+        data = f.read()
+    results = {}
+    for name, func in (('full', full_decode), ('preview', preview_decode)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(data, preview_size)
+        results[name] = (time.perf_counter() - start) / repeat
+    return results
+
+
+def end_to_end(root, preview_size, display_size, executor):
+    """Returns a tuple of (seconds, bytes sent back by the workers) for a
+    scan of root that also decodes every image for display_size, as a
+    front-end would
+    """
+    start = time.perf_counter()
+    sent = 0
+    for _, _, mem in process(
+        root, preview_size=preview_size, executor=executor
+    ):
+        sent += len(mem.data or b'')
+        data = mem.read()
+        if preview_size is None:
+            full_decode(data, display_size)
+        else:
+            Image.open(BytesIO(data)).load()
+    return time.perf_counter() - start, sent
+
+
+def main(images, width, height, preview_size, executor, repeat):
+    with tempfile.TemporaryDirectory() as root:
+        for idx in range(images):
+            synthetic_photo(
+                os.path.join(root, f'img_{idx:04d}.jpg'), width, height
+            )
+        fpath = os.path.join(root, 'img_0000.jpg')
+        print(
+            f'{images} JPEGs of {width}x{height} '
+            f'({os.stat(fpath).st_size:,} bytes each), '
+            f'previews of {preview_size[0]}x{preview_size[1]}'
+        )
+        times = per_image(fpath, preview_size, repeat)
+        print(f'{"":>10} {"decode ms":>10} {"scan s":>10} {"sent MB":>10}')
+        for name, size in (('full', None), ('preview', preview_size)):
+            seconds, sent = end_to_end(root, size, preview_size, executor)
+            print(
+                f'{name:>10} {times[name] * 1000:>10,.1f} '
+                f'{seconds:>10,.2f} {sent / 1024 / 1024:>10,.1f}'
+            )
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Compares decoding previews in the pool workers with '
+                    'decoding the full images in the front-end'
+    )
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--width', type=int, default=7728)
+    parser.add_argument('--height', type=int, default=5152)
+    parser.add_argument('--preview-width', type=int, default=1920)
+    parser.add_argument('--preview-height', type=int, default=1080)
+    parser.add_argument('--executor', default='processes')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(
+        args.images,
+        args.width,
+        args.height,
+        (args.preview_width, args.preview_height),
+        args.executor,
+        args.repeat
+    )
@@ -0,0 +1,97 @@
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import corpus
+
+from executors import Executor
+from search import Scanner, process
+
+
+FRONT_ENDS = ('ascii.py', 'cli.py', 'pyside.py', 'wx_gui.py')
+MODULES = ('search', 'thumbnails', 'ascii', 'cli')
+
+
+def cold_start(args, repeat):
+    """Returns a tuple of the median seconds a fresh interpreter takes to run
+    args, else None if it exits with an error, and its stderr's last line
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, *args],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True
+        )
+        times.append(time.perf_counter() - start)
+        if completed.returncode:
+            lines = completed.stderr.strip().splitlines()
+            return None, lines[-1] if lines else ''
+    return statistics.median(times), ''
+
+
+def scans(root, repeat, start_method):
+    """Returns a tuple of the median seconds per scan of root with a fresh
+    pool every time and with a warm Scanner, counting the Scanner's first
+    scan
+    """
+    fresh = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        executor = Executor(start_method=start_method)
+        list(process(root, previews=False, executor=executor))
+        fresh.append(time.perf_counter() - start)
+    warm = []
+    with Scanner(start_method=start_method) as scanner:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(scanner.process(root, previews=False))
+            warm.append(time.perf_counter() - start)
+    return statistics.median(fresh), statistics.median(warm), warm[0]
+
+
+def main(images, repeat, start_method):
+    print(f'{"cold start":<24} {"median s":>10}')
+    for front_end in FRONT_ENDS:
+        seconds, error = cold_start([front_end, '--help'], repeat)
+        if seconds is None:
+            print(f'{front_end + " --help":<24} {"failed":>10}  {error}')
+        else:
+            print(f'{front_end + " --help":<24} {seconds:>10,.3f}')
+    for module in MODULES:
+        seconds, error = cold_start(['-c', f'import {module}'], repeat)
+        if seconds is None:
+            print(f'{"import " + module:<24} {"failed":>10}  {error}')
+        else:
+            print(f'{"import " + module:<24} {seconds:>10,.3f}')
+    with tempfile.TemporaryDirectory() as root:
+        corpus.generate(root, images=images, max_size=256)
+        fresh, warm, first = scans(root, repeat, start_method)
+    print(
+        f'\n{images} images, scanned {repeat} times '
+        f'({start_method or "default"} start method)'
+    )
+    print(f'{"fresh pool per scan":<24} {fresh:>10,.3f}')
+    print(f'{"warm Scanner":<24} {warm:>10,.3f}')
+    print(f'{"warm Scanner, 1st scan":<24} {first:>10,.3f}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Times cold starts of the front-ends and modules and '
+                    'repeated small scans with and without a warm Scanner'
+    )
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--start-method', choices=('fork', 'forkserver', 'spawn')
+    )
+    args = parser.parse_args()
+    main(args.images, args.repeat, args.start_method)
@@ -0,0 +1,225 @@
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from functools import partial
+
+import corpus
+import perceptual
+
+from ascii import convert
+from executors import Executor
+from search import (
+    ALGORITHMS,
+    ImageData,
+    SeenHashes,
+    generate_hash,
+    process,
+    scan,
+)
+
+
+IMG_TYPES = {'.jpg', '.jpeg', '.tiff', '.gif', '.png'}
+
+
+def timed(func, *args, **kwargs):
+    """Returns a tuple of (seconds, result) for func(*args, **kwargs)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_crawl(root):
+    seconds, found = timed(lambda: list(scan(root, IMG_TYPES)))
+    return {
+        'seconds': seconds,
+        'files': len(found),
+        'files_per_second': len(found) / seconds,
+    }, found
+
+
+def bench_hash(found, algorithm, executor):
+    sizes = {fpath: st.st_size for fpath, st in found}
+    hasher = partial(generate_hash, previews=False, algorithm=algorithm)
+    with Executor(executor) as pool:
+        seconds, digests = timed(
+            lambda: [
+                (fpath, digest)
+                for fpath, digest, _ in pool.map_hash(hasher, sizes)
+            ]
+        )
+    total = sum(sizes.values())
+    return {
+        'seconds': seconds,
+        'algorithm': algorithm,
+        'executor': executor,
+        'bytes': total,
+        'bytes_per_second': total / seconds,
+        'files_per_second': len(sizes) / seconds,
+    }, digests
+
+
+def bench_lookup(digests):
+    seen = SeenHashes()
+    seconds, matches = timed(
+        lambda: sum(
+            bool(seen.check(digest, fpath)) for fpath, digest in digests
+        )
+    )
+    return {
+        'seconds': seconds,
+        'lookups': len(digests),
+        'lookups_per_second': len(digests) / seconds,
+        'matches': matches,
+    }
+
+
+def bench_perceptual(root, max_distance):
+    seconds, results = timed(
+        lambda: list(
+            perceptual.process(
+                root, max_distance=max_distance, previews=False
+            )
+        )
+    )
+    return {
+        'seconds': seconds,
+        'files_per_second': len(results) / seconds,
+        'max_distance': max_distance,
+        'matches': sum(bool(match) for match, _, _ in results),
+    }
+
+
+def bench_render(found, frames, term_width, term_height):
+    mems = []
+    for fpath, _ in found[:frames]:
+        with open(fpath, 'rb') as f:
+            mems.append(ImageData(fpath, f.read()))
+    seconds, _ = timed(
+        lambda: [convert(mem, term_width, term_height) for mem in mems]
+    )
+    return {
+        'seconds': seconds,
+        'frames': len(mems),
+        'frames_per_second': len(mems) / seconds,
+        'term_width': term_width,
+        'term_height': term_height,
+    }
+
+
+def bench_process(root, algorithm, executor):
+    stats = {}
+    seconds, results = timed(
+        lambda: list(
+            process(
+                root,
+                previews=False,
+                stats=stats,
+                algorithm=algorithm,
+                executor=executor
+            )
+        )
+    )
+    return {
+        'seconds': seconds,
+        'files_per_second': len(results) / seconds,
+        'matches': sum(bool(match) for match, _, _ in results),
+        'stats': stats,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(root, args):
+    list(scan(root, IMG_TYPES))  # Warm up the directory cache
+    crawl_results, found = bench_crawl(root)
+    hash_results, digests = bench_hash(found, args.algorithm, args.executor)
+    return {
+        'crawl': crawl_results,
+        'hash': hash_results,
+        'lookup': bench_lookup(digests),
+        'perceptual': bench_perceptual(root, args.max_distance),
+        'render': bench_render(
+            found, args.frames, args.term_width, args.term_height
+        ),
+        'process': bench_process(root, args.algorithm, args.executor),
+    }
+
+
+def main(args):
+    corpus_args = {
+        'images': args.images,
+        'duplicate_ratio': args.duplicate_ratio,
+        'near_duplicate_ratio': args.near_duplicate_ratio,
+        'min_size': args.min_size,
+        'max_size': args.max_size,
+        'fanout': args.fanout,
+        'depth': args.depth,
+        'seed': args.seed,
+    }
+    with tempfile.TemporaryDirectory() as tmp_root:
+        root = args.corpus or tmp_root
+        if not os.path.exists(os.path.join(root, 'manifest.json')):
+            corpus.generate(root, **corpus_args)
+        with open(os.path.join(root, 'manifest.json')) as f:
+            manifest = json.load(f)
+        results = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'corpus': manifest,
+            'results': run(root, args),
+        }
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Times crawl, hash, lookup and render on a synthetic '
+                    'corpus and prints the results as JSON'
+    )
+    parser.add_argument(
+        '--corpus',
+        help='Directory to reuse (or create) the corpus in. '
+             'A temporary directory is used if not given'
+    )
+    parser.add_argument('--output', help='Filepath to write the JSON to')
+    parser.add_argument('--images', type=int, default=500)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2)
+    parser.add_argument('--near-duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--min-size', type=int, default=64)
+    parser.add_argument('--max-size', type=int, default=2048)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--algorithm', choices=list(ALGORITHMS), default='md5'
+    )
+    parser.add_argument('--executor', default='processes')
+    parser.add_argument('--max-distance', type=int, default=10)
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--term-width', type=int, default=200)
+    parser.add_argument('--term-height', type=int, default=60)
+    main(parser.parse_args())
@@ -0,0 +1,219 @@
+import json
+import os
+import sys
+
+import metrics
+import watch
+
+from executors import MODES, QUEUE_DEPTH
+from search import ALGORITHMS, find
+
+
+def main(
+    cwd,
+    output=None,
+    report=None,
+    img_types=None,
+    watching=False,
+    **find_kwargs
+):
+    """Scans cwd without decoding images or reading previews. Writes one JSON
+    object per file to output as results arrive and, if report is given, a
+    grouped duplicate report once the scan is finished.
+
+    Each line has the keys path, size, digest (hex or null if the file was
+    found unique without a full hash), duplicate_of (the first path seen
+    with the same digest or null) and error.
+
+    With watching, cwd is watched for new and changed images once it has
+    been scanned, see watch.watch, and every line is flushed as it is
+    written. The report is written once watching is interrupted with
+    Ctrl+C.
+
+    Optional:
+        output (arg/kwarg): Filepath for the JSON Lines. Defaults to stdout
+        report (arg/kwarg): Filepath for the duplicate report JSON
+        img_types (kwarg): Array object containting exention types to use
+        watching (kwarg): If True, keeps watching cwd after the scan
+        find_kwargs (kwargs): Passed on to search.find, or watch.watch
+
+    returns a dict of the counts in the report
+    """
+    groups = {}
+    counts = {'files': 0, 'duplicates': 0, 'duplicate_bytes': 0, 'errors': 0}
+    out = sys.stdout if output is None else open(output, 'w')
+    search = watch.watch if watching else find
+    try:
+        for result in search(cwd, img_types, previews=False, **find_kwargs):
+            digest = None if result.digest is None else result.digest.hex()
+            duplicate_of = None
+            if result.match:
+                duplicate_of = os.fspath(result.match.fpath)
+            out.write(
+                json.dumps(
+                    {
+                        'path': os.fspath(result.fpath),
+                        'size': result.size,
+                        'digest': digest,
+                        'duplicate_of': duplicate_of,
+                        'error': result.error,
+                    },
+                    separators=(',', ':')
+                )
+            )
+            out.write('\n')
+            if watching:
+                out.flush()
+            counts['files'] += 1
+            if result.error is not None:
+                counts['errors'] += 1
+            if duplicate_of is not None:
+                counts['duplicates'] += 1
+                counts['duplicate_bytes'] += result.size
+                if (group := groups.get(digest)) is None:
+                    group = groups[digest] = {
+                        'digest': digest,
+                        'size': result.size,
+                        'paths': [duplicate_of],
+                    }
+                group['paths'].append(os.fspath(result.fpath))
+    except KeyboardInterrupt:
+        if not watching:
+            raise
+    finally:
+        if output is None:
+            out.flush()
+        else:
+            out.close()
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump(
+                {
+                    'root': os.path.abspath(cwd),
+                    **counts,
+                    'groups': sorted(
+                        groups.values(),
+                        key=lambda group: group['size'] * len(group['paths']),
+                        reverse=True
+                    ),
+                },
+                f,
+                indent=1
+            )
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Headless duplicate image search that streams JSON Lines'
+    )
+    parser.add_argument('cwd')
+    parser.add_argument(
+        '-o', '--output', help='Filepath for the JSON Lines. Default stdout'
+    )
+    parser.add_argument(
+        '-r', '--report', help='Filepath for the grouped duplicate report'
+    )
+    parser.add_argument(
+        '--types',
+        nargs='+',
+        help='Extensions to search for, e.g. .jpg .png'
+    )
+    parser.add_argument(
+        '--index', help='Filepath of an on-disk index to reuse between scans'
+    )
+    parser.add_argument(
+        '--algorithm', choices=list(ALGORITHMS), default='md5'
+    )
+    parser.add_argument(
+        '--payload-only',
+        action='store_true',
+        help='Match JPEGs and PNGs on their image data alone, ignoring '
+             'EXIF, XMP and other metadata'
+    )
+    parser.add_argument('--executor', choices=MODES, default='processes')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--queue-depth', type=int, default=QUEUE_DEPTH)
+    parser.add_argument(
+        '--memory-limit',
+        type=int,
+        help='Most MiB of file data to hold at once across all workers'
+    )
+    parser.add_argument(
+        '--tree-hash',
+        type=int,
+        metavar='MIB',
+        help='Split the hashing of files of at least MIB MiB across the '
+             'workers'
+    )
+    parser.add_argument(
+        '--exclude', nargs='+', help='Glob patterns of paths to skip'
+    )
+    parser.add_argument('--max-depth', type=int)
+    parser.add_argument('--follow-symlinks', action='store_true')
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep watching cwd after the scan and report new and changed '
+             'images as they are written, until Ctrl+C'
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Filepath to write stage metrics to, as Prometheus text if it '
+             'ends with .prom else JSON'
+    )
+    args = parser.parse_args()
+    if args.watch and args.tree_hash is not None:
+        parser.error('--tree-hash can not be used with --watch')
+    if args.metrics:
+        metrics.enable()
+    stats = {}
+    counts = main(
+        args.cwd,
+        output=args.output,
+        report=args.report,
+        img_types=None if args.types is None else {
+            ext.lower() for ext in args.types
+        },
+        watching=args.watch,
+        index_path=args.index,
+        algorithm=args.algorithm,
+        payload_only=args.payload_only,
+        executor=args.executor,
+        workers=args.workers,
+        queue_depth=args.queue_depth,
+        memory_limit=None if args.memory_limit is None else (
+            args.memory_limit * 1024 * 1024
+        ),
+        tree_min_bytes=None if args.tree_hash is None else (
+            args.tree_hash * 1024 * 1024
+        ),
+        stats=stats,
+        exclude=args.exclude,
+        max_depth=args.max_depth,
+        follow_symlinks=args.follow_symlinks
+    )
+    if args.metrics:
+        metrics.current.write(args.metrics)
+    print(
+        f'Processed: {counts["files"]:,} | '
+        f'Duplicates: {counts["duplicates"]:,} | '
+        f'Errors: {counts["errors"]:,}',
+        file=sys.stderr
+    )
+    if stats.get('worker_utilisation') is not None:
+        print(
+            f'Pool: {stats["pool_seconds"]:,.2f}s | '
+            f'Tail: {stats["tail_seconds"]:,.2f}s | '
+            f'Worker utilisation: {stats["worker_utilisation"]:.0%}',
+            file=sys.stderr
+        )
+    if stats.get('peak_rss_bytes') is not None:
+        print(
+            f'Peak RSS: {stats["peak_rss_bytes"] / 1024 / 1024:,.1f} MiB | '
+            f'Largest worker: '
+            f'{stats["peak_worker_rss_bytes"] / 1024 / 1024:,.1f} MiB',
+            file=sys.stderr
+        )
@@ -0,0 +1,143 @@
+import json
+import math
+import os
+import random
+import shutil
+
+from PIL import Image
+
+
+def generate(
+    root,
+    images=1000,
+    duplicate_ratio=0.2,
+    near_duplicate_ratio=0.1,
+    min_size=64,
+    max_size=2048,
+    fanout=4,
+    depth=2,
+    seed=0
+):
+    """Writes a reproducible corpus of JPEG and PNG images under root and
+    returns a manifest dict describing it. The same arguments always produce
+    the same files.
+
+    Originals are smooth random images with a log-uniform size between
+    min_size and max_size. Duplicates are byte-identical copies of an
+    earlier original and near-duplicates are resized, re-encoded copies.
+
+    Required:
+        root (arg): Directory to write the corpus to. Created if needed
+
+    Optional:
+        images (kwarg): Total number of files to write
+        duplicate_ratio (kwarg): Fraction of files that are exact copies
+        near_duplicate_ratio (kwarg): Fraction of files that are re-encoded
+        min_size (kwarg): Smallest width/height of an original in pixels
+        max_size (kwarg): Largest width/height of an original in pixels
+        fanout (kwarg): Number of subdirectories in each directory
+        depth (kwarg): Number of levels of subdirectories
+        seed (kwarg): Seed for the random number generator
+    """
+    rng = random.Random(seed)
+    dirs = make_dirs(root, fanout, depth)
+    duplicates = int(images * duplicate_ratio)
+    near_duplicates = int(images * near_duplicate_ratio)
+    originals = max(images - duplicates - near_duplicates, 1)
+    manifest = {
+        'root': os.path.abspath(root),
+        'seed': seed,
+        'images': 0,
+        'originals': 0,
+        'duplicates': 0,
+        'near_duplicates': 0,
+        'bytes': 0,
+        'directories': len(dirs),
+    }
+    written = []
+    for idx in range(images):
+        fpath = os.path.join(rng.choice(dirs), f'img_{idx:07d}')
+        if idx < originals:
+            fpath = write_original(rng, fpath, min_size, max_size)
+            manifest['originals'] += 1
+        elif idx < originals + duplicates:
+            source = rng.choice(written[:originals])
+            fpath += os.path.splitext(source)[1]
+            shutil.copyfile(source, fpath)
+            manifest['duplicates'] += 1
+        else:
+            source = rng.choice(written[:originals])
+            fpath = write_near_duplicate(rng, source, fpath)
+            manifest['near_duplicates'] += 1
+        written.append(fpath)
+        manifest['images'] += 1
+        manifest['bytes'] += os.stat(fpath).st_size
+    with open(os.path.join(root, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def make_dirs(root, fanout, depth):
+    """Creates the directory tree and returns every directory in it"""
+    dirs = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [
+            os.path.join(parent, f'dir_{idx:03d}')
+            for parent in level
+            for idx in range(fanout)
+        ]
+        dirs.extend(level)
+    for directory in dirs:
+        os.makedirs(directory, exist_ok=True)
+    return dirs
+
+
+def write_original(rng, fpath, min_size, max_size):
+    """Writes a smooth random image by upscaling a tiny random one, which
+    keeps perceptual hashes stable under re-encoding. Returns the filepath.
+    """
+    width, height = (
+        int(math.exp(rng.uniform(math.log(min_size), math.log(max_size))))
+        for _ in range(2)
+    )
+    img = Image.frombytes('RGB', (8, 8), rng.randbytes(8 * 8 * 3))
+    img = img.resize((width, height), Image.BICUBIC)
+    if rng.random() < 0.8:
+        fpath += '.jpg'
+        img.save(fpath, quality=rng.randint(70, 95))
+    else:
+        fpath += '.png'
+        img.save(fpath)
+    return fpath
+
+
+def write_near_duplicate(rng, source, fpath):
+    """Writes a resized, re-encoded JPEG copy of source. Returns the
+    filepath.
+    """
+    fpath += '.jpg'
+    with Image.open(source) as img:
+        scale = rng.uniform(0.5, 0.9)
+        width = max(int(img.width * scale), 1)
+        height = max(int(img.height * scale), 1)
+        img = img.convert('RGB').resize((width, height))
+        img.save(fpath, quality=rng.randint(50, 90))
+    return fpath
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root')
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2)
+    parser.add_argument('--near-duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--min-size', type=int, default=64)
+    parser.add_argument('--max-size', type=int, default=2048)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(generate(**vars(args)), indent=2))
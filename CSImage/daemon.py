@@ -0,0 +1,506 @@
+import json
+import os
+import socket
+import socketserver
+import sqlite3
+import tempfile
+import time
+
+from functools import partial
+from multiprocessing import Pool
+from threading import Lock
+
+import index
+import metrics
+import shards
+
+from search import ALGORITHMS, find, generate_hash
+
+
+MAX_DISTANCE = 10
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'csimage.sock')
+
+
+class Library:
+    """The digests, and optionally the perceptual hashes, of a library of
+    images held in memory so "is this image already in the library?" is a
+    dict lookup, or a search of a perceptual.MultiIndex for near-duplicates,
+    instead of a scan.
+
+    Digests are loaded from an on-disk index, from shard sets written by
+    shards.scan and by scanning the library's roots. find only hashes the
+    files that could be duplicates of each other, so an index it wrote may
+    not hold every file, unlike the shards and scan. Files inserted later
+    are hashed with generate_hash and written to the on-disk index if there
+    is one, so they are loaded again on the next start.
+
+    Optional:
+        algorithm (arg/kwarg): Name of the hash algorithm found in ALGORITHMS
+        index_path (kwarg): Filepath of an on-disk index to load and update
+        payload_only (kwarg): If True, digests are of the image data alone,
+                              see find
+        perceptual (kwarg): If True, near-duplicate lookups are answered too
+    """
+
+    def __init__(
+        self,
+        algorithm='md5',
+        index_path=None,
+        payload_only=False,
+        perceptual=False
+    ):
+        if algorithm not in ALGORITHMS:
+            choices = ', '.join(ALGORITHMS)
+            raise ValueError(f'algorithm must be one of {choices}')
+        self.algorithm = algorithm
+        self.payload_only = payload_only
+        self.index_path = index_path
+        self.index_algorithm = (
+            f'{algorithm}+payload' if payload_only else algorithm
+        )
+        self.lock = Lock()
+        self.paths = {}  # Filepaths by digest, in the order they were added
+        self.digests = {}  # Digest by filepath
+        self.tree = None
+        self.con = None
+        if perceptual:
+            from perceptual import MultiIndex
+
+            self.tree = MultiIndex()
+        if index_path is not None:
+            self.con = sqlite3.connect(index_path, check_same_thread=False)
+            index.setup_index(self.con.cursor())
+            for path, digest in self.con.execute(
+                'SELECT path, hash FROM file_index WHERE algorithm = (?);',
+                (self.index_algorithm,)
+            ):
+                self.add(digest, path)
+
+    def load_shards(self, paths):
+        """Adds every entry of the shard sets found in paths, see
+        shards.find_sets. Raises ValueError if a shard set was written with
+        a different algorithm.
+        """
+        for shard_set in shards.find_sets(paths):
+            meta = shards.read_meta(shard_set)
+            if meta['algorithm'] != self.index_algorithm:
+                raise ValueError(
+                    f'{shard_set} was written with {meta["algorithm"]}'
+                )
+            if meta['tree_min_bytes'] is not None:
+                raise ValueError(f'{shard_set} holds tree digests')
+            for digest, _, _, path in shards.read_set(shard_set, meta):
+                self.add(digest, path)
+
+    def scan(self, roots, **find_kwargs):
+        """Adds every image under roots, hashing each of them in full with
+        find, which reads and updates the on-disk index if there is one
+
+        Required:
+            roots (arg): Array object of directories
+
+        Optional:
+            find_kwargs (kwargs): Passed on to find
+        """
+        for root in roots:
+            for result in find(
+                root,
+                previews=False,
+                index_path=self.index_path,
+                algorithm=self.algorithm,
+                payload_only=self.payload_only,
+                hash_all=True,
+                **find_kwargs
+            ):
+                if result.digest is not None:
+                    self.add(result.digest, os.path.abspath(result.fpath))
+
+    def load_perceptual(self, processes=None):
+        """Adds the perceptual hash of every file already added, hashing
+        them on a Pool of processes
+        """
+        from perceptual import generate_dhash
+
+        fpaths = [fpath for fpaths in self.paths.values() for fpath in fpaths]
+        with Pool(processes) as pool:
+            for fpath, p_hash, _ in pool.imap_unordered(
+                partial(generate_dhash, previews=False), fpaths, 64
+            ):
+                if not isinstance(p_hash, Exception):
+                    with self.lock:
+                        self.tree.add(p_hash, fpath)
+
+    def add(self, digest, fpath):
+        """Adds fpath under digest, moving it if it was added under another
+        digest before, which also drops its perceptual hash as it is of the
+        old contents. Returns False if it was already there.
+        """
+        with self.lock:
+            if (old := self.digests.get(fpath)) == digest:
+                return False
+            if old is not None:
+                self.paths[old].remove(fpath)
+                if not self.paths[old]:
+                    del self.paths[old]
+                if self.tree is not None:
+                    self.tree.remove(fpath)
+            self.digests[fpath] = digest
+            self.paths.setdefault(digest, []).append(fpath)
+            return True
+
+    def lookup(self, digest):
+        """Returns a list of the filepaths with digest, oldest first"""
+        return list(self.paths.get(digest, ()))
+
+    def near(self, p_hash, max_distance=MAX_DISTANCE):
+        """Returns a Match of the closest filepath within max_distance of
+        the perceptual hash, else None
+        """
+        if self.tree is None:
+            raise ValueError('The perceptual index is not loaded')
+        with self.lock:
+            return self.tree.find(p_hash, max_distance)
+
+    def hash(self, fpath):
+        """Returns the digest of the file, from the on-disk index if it is
+        there and unchanged. Raises OSError if the file can't be read.
+        """
+        st = os.stat(fpath)
+        key = index.index_key(fpath, st)
+        if self.con is not None:
+            with self.lock:
+                digest = index.lookup(
+                    self.con.cursor(), key, self.index_algorithm
+                )
+            if digest is not None:
+                return digest
+        _, digest, _ = generate_hash(
+            fpath,
+            previews=False,
+            algorithm=self.algorithm,
+            payload_only=self.payload_only
+        )
+        if isinstance(digest, Exception):
+            raise OSError(str(digest))
+        if self.con is not None:
+            with self.lock:
+                index.update(
+                    self.con.cursor(), key, self.index_algorithm, digest
+                )
+                self.con.commit()
+        return digest
+
+    def perceptual_hash(self, fpath):
+        from perceptual import generate_dhash
+
+        _, p_hash, _ = generate_dhash(fpath, previews=False)
+        if isinstance(p_hash, Exception):
+            raise OSError(str(p_hash))
+        return p_hash
+
+    def insert(self, fpath, digest=None, p_hash=None):
+        """Adds the file, hashing it unless its digest is given, and returns
+        its digest. The perceptual hash is only made and added if the
+        perceptual index is loaded and the file is new or changed, in which
+        case it replaces the one of the old contents.
+        """
+        fpath = os.path.abspath(fpath)
+        if digest is None:
+            digest = self.hash(fpath)
+        elif self.con is not None and os.path.exists(fpath):
+            key = index.index_key(fpath, os.stat(fpath))
+            with self.lock:
+                index.update(
+                    self.con.cursor(), key, self.index_algorithm, digest
+                )
+                self.con.commit()
+        if self.add(digest, fpath) and self.tree is not None:
+            if p_hash is None:
+                p_hash = self.perceptual_hash(fpath)
+            with self.lock:
+                self.tree.add(p_hash, fpath)
+        return digest
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+
+def respond(library, request):
+    """Returns the response dict for a request dict. Every op takes either
+    one item or a list of them and answers with a list of results:
+
+        lookup: "digest(s)" hex or "path(s)" to hash, answered with the
+                "digest" and the "matches", the filepaths holding it
+        near: "phash(es)" int or "path(s)" to hash and "max_distance",
+              answered with the closest filepath, "match", and its
+              "distance", or nulls
+        insert: "path(s)", or "entries" of {"path", "digest", "phash"}
+                that were hashed elsewhere, answered with their digests
+        stats: the number of digests, files and perceptual hashes held
+
+    A result that failed has an "error" in place of its answer.
+    """
+    op = request.get('op')
+    if op == 'stats':
+        return {
+            'digests': len(library.paths),
+            'files': len(library.digests),
+            'perceptual': None if library.tree is None else len(library.tree),
+        }
+    if op == 'lookup':
+        results = []
+        for key, value in items(request, 'digest', 'path'):
+            try:
+                if key == 'digest':
+                    digest = bytes.fromhex(value)
+                else:
+                    digest = library.hash(value)
+            except (OSError, ValueError, TypeError) as e:
+                results.append({key: value, 'error': str(e)})
+            else:
+                results.append(
+                    {
+                        key: value,
+                        'digest': digest.hex(),
+                        'matches': library.lookup(digest),
+                    }
+                )
+        return {'results': results}
+    if op == 'near':
+        max_distance = request.get('max_distance', MAX_DISTANCE)
+        results = []
+        for key, value in items(request, 'phash', 'path'):
+            try:
+                if key == 'phash':
+                    p_hash = int(value)
+                    if not 0 <= p_hash < 1 << 64:
+                        raise ValueError('phash must be a 64 bit int')
+                else:
+                    p_hash = library.perceptual_hash(value)
+                match = library.near(p_hash, max_distance)
+            except (OSError, ValueError, TypeError) as e:
+                results.append({key: value, 'error': str(e)})
+            else:
+                results.append(
+                    {
+                        key: value,
+                        'match': None if match is None else match.fpath,
+                        'distance': None if match is None else match.distance,
+                    }
+                )
+        return {'results': results}
+    if op == 'insert':
+        results = []
+        entries = [{'path': path} for _, path in items(request, 'path')]
+        entries.extend(request.get('entries', ()))
+        for entry in entries:
+            try:
+                digest = library.insert(
+                    entry['path'],
+                    None if entry.get('digest') is None else bytes.fromhex(
+                        entry['digest']
+                    ),
+                    entry.get('phash')
+                )
+            except (KeyError, OSError, ValueError, TypeError) as e:
+                results.append({'path': entry.get('path'), 'error': str(e)})
+            else:
+                results.append({'path': entry['path'], 'digest': digest.hex()})
+        return {'results': results}
+    raise ValueError(f'Unknown op {op!r}')
+
+
+def items(request, *keys):
+    """Iterator that yields a tuple of (key, value) for the request's key,
+    or every value in the list under its plural, for each of keys
+    """
+    for key in keys:
+        plural = 'phashes' if key == 'phash' else f'{key}s'
+        if key in request:
+            yield key, request[key]
+        for value in request.get(plural, ()):
+            yield key, value
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Answers requests sent as one JSON object per line with one JSON
+    object per line, in order, until the client disconnects
+    """
+
+    def handle(self):
+        library = self.server.library
+        recorder = metrics.recorder()
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            start = time.perf_counter()
+            try:
+                request = json.loads(line)
+                response = respond(library, request)
+            except Exception as e:
+                request, response = {}, {'error': str(e)}
+            self.wfile.write(
+                json.dumps(response, separators=(',', ':')).encode()
+            )
+            self.wfile.write(b'\n')
+            if recorder is not None:
+                recorder.observe(
+                    f'query_{request.get("op")}', time.perf_counter() - start
+                )
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(library, address=SOCKET_PATH, ready=None):
+    """Answers requests for library until interrupted. address is the
+    filepath of a Unix socket, replaced if it exists, or a (host, port)
+    tuple to listen on with TCP, which should be a localhost one as there
+    is no authentication. ready, a threading or multiprocessing Event, is
+    set once requests are accepted.
+    """
+    if isinstance(address, tuple):
+        server = TCPServer(address, Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixServer(address, Handler)
+    server.library = library
+    try:
+        if ready is not None:
+            ready.set()
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple):
+            try:
+                os.remove(address)
+            except OSError:
+                pass
+
+
+class Client:
+    """Connection to a daemon started with serve
+
+    Optional:
+        address (arg/kwarg): The address serve was given
+    """
+
+    def __init__(self, address=SOCKET_PATH):
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.rfile = self.sock.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, **request):
+        """Returns the response dict to the request, see respond"""
+        self.sock.sendall(
+            json.dumps(request, separators=(',', ':')).encode() + b'\n'
+        )
+        response = json.loads(self.rfile.readline())
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+def parse_address(address):
+    """Returns address as a (host, port) tuple if it is host:port or a port,
+    else as the filepath of a Unix socket
+    """
+    host, _, port = address.rpartition(':')
+    if port.isdigit() and os.sep not in address:
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description='Keeps the duplicate index in memory and answers exact '
+                    'and near-duplicate lookups over a local socket'
+    )
+    parser.add_argument(
+        '--address',
+        default=SOCKET_PATH,
+        help='Filepath of the Unix socket, or [host:]port to listen on '
+             'with TCP. Default %(default)s'
+    )
+    parser.add_argument(
+        '--index', help='Filepath of an on-disk index to load and update'
+    )
+    parser.add_argument(
+        '--shards', nargs='+', help='Shard sets, or directories of them'
+    )
+    parser.add_argument(
+        '--scan',
+        nargs='+',
+        help='Directories of the library to scan and hash every image of'
+    )
+    parser.add_argument(
+        '--algorithm', choices=list(ALGORITHMS), default='md5'
+    )
+    parser.add_argument('--payload-only', action='store_true')
+    parser.add_argument(
+        '--perceptual',
+        action='store_true',
+        help='Hash every loaded image perceptually for near lookups'
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Filepath to write query metrics to on exit, as Prometheus '
+             'text if it ends with .prom else JSON'
+    )
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+    start = time.perf_counter()
+    library = Library(
+        args.algorithm,
+        index_path=args.index,
+        payload_only=args.payload_only,
+        perceptual=args.perceptual
+    )
+    if args.shards:
+        library.load_shards(args.shards)
+    if args.scan:
+        library.scan(args.scan)
+    if args.perceptual:
+        library.load_perceptual()
+    address = parse_address(args.address)
+    print(
+        f'Loaded {len(library.digests):,} files with {len(library.paths):,} '
+        f'digests in {time.perf_counter() - start:,.2f}s, listening on '
+        f'{address}',
+        file=sys.stderr
+    )
+    try:
+        serve(library, address)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        library.close()
+        if args.metrics:
+            metrics.current.write(args.metrics)
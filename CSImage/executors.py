@@ -0,0 +1,515 @@
+import hashlib
+import multiprocessing
+import os
+import time
+
+from multiprocessing.pool import ThreadPool
+from threading import Condition, Event, Lock, Semaphore, local
+
+import metrics
+
+
+BATCH_FILES = 64
+CHUNKSIZE = 10
+GUIDED_FACTOR = 4  # Batches left per worker that a batch target aims for
+MAX_BATCH_BYTES = 64 * 1024 * 1024
+MIN_BATCH_BYTES = 1024 * 1024
+MODES = ('auto', 'processes', 'threads', 'hybrid')
+PROBE_BYTES = 8 * 1024 * 1024
+PROBE_FILES = 16
+PROBE_LATENCY = 0.005  # Seconds per open + first read before hybrid is used
+QUEUE_DEPTH = 256
+
+buffers = local()  # Reused read buffers for warm, one per thread
+
+
+class Executor:
+    """Runs the pool stages of search.process with processes, threads or a
+    hybrid of I/O threads warming files ahead of hashing processes.
+
+    Stages that read little per file (partial hashes, previews) run through
+    map_io and full hashing runs through map_hash. At most queue_depth files
+    are in flight at once, whatever the mode.
+
+    Each with block is one scan. Every task is timed, so after it
+    busy_seconds, tail_seconds (time spent at the end of each stage with
+    workers idle for want of work) and utilisation (busy time over the
+    pools' capacity) are set for the scan, with or without metrics.
+
+    The pools are started on entering and shut down on leaving, unless the
+    Executor is persistent, in which case they are kept warm for the next
+    scan until close() is called. Tasks still queued from a scan that was
+    left early are not fed any further, though those already sent finish.
+
+    Optional:
+        mode (arg/kwarg): One of MODES. 'auto' picks a mode with probe, from
+                          sample if given, else on the first resolve call
+        workers (kwarg): Number of worker processes or threads.
+                         Defaults to os.cpu_count()
+        queue_depth (kwarg): Largest number of files in flight at once
+        sample (kwarg): Filepaths for the 'auto' throughput probe
+        hash_factory (kwarg): Hash constructor for the 'auto' probe
+        chunksize (kwarg): Number of items sent to a worker at a time.
+                           Defaults to CHUNKSIZE or less for a small
+                           queue_depth. Must be 1 when the items come
+                           through a MemoryBudget, as a part-filled chunk
+                           would hold budget without being sent. Reset to
+                           the default on entering when not given
+        persistent (kwarg): If True, the pools outlive the with block
+        start_method (kwarg): multiprocessing start method of the worker
+                              processes, e.g. 'forkserver' or 'spawn'.
+                              Defaults to the platform's
+    """
+
+    def __init__(
+        self,
+        mode='processes',
+        workers=None,
+        queue_depth=QUEUE_DEPTH,
+        sample=(),
+        hash_factory=None,
+        chunksize=None,
+        persistent=False,
+        start_method=None
+    ):
+        if mode not in MODES:
+            raise ValueError(f'mode must be one of {", ".join(MODES)}')
+        self.mode = mode
+        if sample:
+            self.resolve(sample, hash_factory)
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_depth = max(queue_depth, 1)
+        self.default_chunksize = chunksize or max(
+            1, min(CHUNKSIZE, self.queue_depth // self.workers)
+        )
+        self.chunksize = self.default_chunksize
+        self.persistent = persistent
+        self.context = multiprocessing.get_context(start_method)
+        self.closed = False
+        self.active = False
+        self.stopped = Event()
+        self.io_pool = self.hash_pool = None
+        self.started = None
+        self.busy_seconds = 0.0
+        self.tail_seconds = 0.0
+        self.utilisation = None
+        self.in_flight = 0  # Files
+        self.tasks = 0  # Tasks, which hold several files when batched
+        # feed runs in a pool's task handler thread and unwrap in the
+        # consumer's, or another task handler's in hybrid mode
+        self.counts_lock = Lock()
+
+    def __enter__(self):
+        if self.closed:
+            raise ValueError('Executor is closed')
+        if self.active:
+            raise RuntimeError('Executor is already running a scan')
+        self.active = True
+        self.stopped = Event()
+        self.chunksize = self.default_chunksize
+        self.busy_seconds = self.tail_seconds = 0.0
+        self.utilisation = None
+        self.in_flight = self.tasks = 0
+        self.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.active = False
+        if not self.persistent:
+            self.close()
+        pools = 2 if self.mode == 'hybrid' else 1
+        capacity = (time.perf_counter() - self.started) * self.workers * pools
+        if capacity:
+            self.utilisation = min(self.busy_seconds / capacity, 1.0)
+        if (recorder := metrics.recorder()) is not None:
+            recorder.inc(
+                'worker_idle_seconds', max(capacity - self.busy_seconds, 0)
+            )
+            recorder.inc('tail_seconds', self.tail_seconds)
+            if self.utilisation is not None:
+                recorder.gauge('worker_utilisation', self.utilisation)
+
+    def resolve(self, sample, hash_factory=None):
+        """Picks the mode with probe if it is still 'auto'"""
+        if self.mode == 'auto':
+            self.mode = probe(sample, hash_factory)
+
+    def start(self):
+        """Starts the pools if they aren't running"""
+        if self.io_pool is not None:
+            return
+        self.resolve(())
+        if self.mode == 'processes':
+            self.io_pool = self.hash_pool = self.context.Pool(self.workers)
+        elif self.mode == 'threads':
+            self.io_pool = self.hash_pool = ThreadPool(self.workers)
+        else:
+            self.io_pool = ThreadPool(self.workers)
+            self.hash_pool = self.context.Pool(self.workers)
+
+    def close(self):
+        """Shuts the pools down, ending any scan still running"""
+        self.closed = True
+        self.stopped.set()
+        for pool in {self.io_pool, self.hash_pool} - {None}:
+            pool.terminate()
+            pool.join()
+        self.io_pool = self.hash_pool = None
+
+    def map_io(self, func, iterable, batched=False):
+        """Iterator of func(item) for each item, in completion order. If
+        batched, each item of iterable is a tuple of items, like those of a
+        Schedule, sent to a single worker as one task.
+        """
+        chunksize = 1 if batched else self.chunksize
+        yield from self.bounded(
+            self.io_pool, func, iterable, chunksize, batched
+        )
+
+    def map_hash(self, func, iterable, batched=False):
+        """Iterator of func(item) for each item, in completion order. In
+        hybrid mode each file is read by an I/O thread first so the hashing
+        process finds it in the page cache. See map_io for batched.
+        """
+        if self.mode != 'hybrid':
+            yield from self.map_io(func, iterable, batched)
+            return
+        slots = Semaphore(self.queue_depth)
+        tail = []  # When the stage's tail started, see unwrap
+        if batched:
+            func = Batch(func)
+        warmed = self.io_pool.imap_unordered(
+            self.instrument(Batch(warm) if batched else warm),
+            self.feed(iterable, slots, tail, self.stopped, batched)
+        )
+        yield from self.unwrap(
+            self.hash_pool.imap_unordered(
+                self.instrument(func),
+                self.unwrap(warmed),
+                1 if batched else self.chunksize
+            ),
+            slots,
+            tail,
+            batched
+        )
+
+    def bounded(self, pool, func, iterable, chunksize, batched=False):
+        slots = Semaphore(self.queue_depth)
+        tail = []  # When the stage's tail started, see unwrap
+        if batched:
+            func = Batch(func)
+        yield from self.unwrap(
+            pool.imap_unordered(
+                self.instrument(func),
+                self.feed(iterable, slots, tail, self.stopped, batched),
+                chunksize
+            ),
+            slots,
+            tail,
+            batched
+        )
+
+    def instrument(self, func):
+        """Returns func wrapped in metrics.Instrumented if metrics are
+        enabled, else in Timed
+        """
+        if metrics.recorder() is None:
+            return Timed(func)
+        return metrics.Instrumented(func)
+
+    def unwrap(self, results, slots=None, tail=None, batched=False):
+        """Iterator over the pool results that frees a slot for each file,
+        adds up the time spent in the workers and merges the worker metrics
+        if they are enabled. Batched results are yielded one by one.
+
+        A stage's tail starts once every task has been sent and fewer than
+        workers are left in flight, so some worker has nothing to do. feed
+        or unwrap, whichever sees that first, puts the time in tail.
+        """
+        recorder = metrics.recorder()
+        try:
+            for result, sample in results:
+                with self.counts_lock:
+                    self.busy_seconds += sample['seconds']
+                if recorder is not None:
+                    recorder.merge(sample)
+                if slots is not None:
+                    files = len(result) if batched else 1
+                    with self.counts_lock:
+                        self.in_flight -= files
+                        self.tasks -= 1
+                        in_flight = self.in_flight
+                        if self.tasks < self.workers and tail == [None]:
+                            tail[0] = time.perf_counter()
+                    for _ in range(files):
+                        slots.release()
+                    if recorder is not None:
+                        recorder.gauge('queue_depth', in_flight)
+                if batched:
+                    yield from result
+                else:
+                    yield result
+        finally:
+            with self.counts_lock:
+                if tail and tail[0] is not None:
+                    self.tail_seconds += time.perf_counter() - tail[0]
+
+    def feed(self, iterable, slots, tail, stopped, batched=False):
+        """Iterator over iterable that blocks while queue_depth files are in
+        flight, ending once the scan's stopped Event is set. Runs in the
+        pool's task handler thread.
+        """
+        for item in iterable:
+            if stopped.is_set():
+                return
+            files = len(item) if batched else 1
+            for _ in range(files):
+                while not slots.acquire(timeout=0.1):
+                    if stopped.is_set():
+                        return
+            with self.counts_lock:
+                self.in_flight += files
+                self.tasks += 1
+            yield item
+        with self.counts_lock:
+            tail.append(
+                time.perf_counter() if self.tasks < self.workers else None
+            )
+
+
+class Batch:
+    """Wraps a pool worker function so it is called with a tuple of items
+    and returns a list of their results. With metrics enabled each item is
+    still observed under the function's name.
+
+    Required:
+        func (arg): The worker function
+    """
+
+    def __init__(self, func):
+        self.target = func
+        self.stage = getattr(func, 'func', func).__name__
+        self.__name__ = f'{self.stage}_batch'
+
+    def __call__(self, items):
+        if (recorder := metrics.recorder()) is None:
+            return [self.target(item) for item in items]
+        results = []
+        for item in items:
+            with recorder.timer(self.stage):
+                results.append(self.target(item))
+        return results
+
+
+class Timed:
+    """Wraps a pool worker function so each call returns a tuple of
+    (result, {'seconds': duration}), the part of a metrics.Instrumented
+    sample the Executor needs when metrics are disabled
+
+    Required:
+        func (arg): The worker function
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        start = time.perf_counter()
+        result = self.func(item)
+        return result, {'seconds': time.perf_counter() - start}
+
+
+class Schedule:
+    """Orders items largest first and packs them into tuples for the
+    batched mode of an Executor's map_io or map_hash. Each batch aims for
+    an equal share of the bytes left, GUIDED_FACTOR batches per worker
+    within MIN_BATCH_BYTES and MAX_BATCH_BYTES, so the batches shrink as
+    the scan nears its end and the workers finish close together. An item
+    at least as large as the target is always sent on its own.
+
+    Iterating yields the batches. done(item) is called for each result and
+    returns its batch once every item in it is done, else None, so a
+    MemoryBudget that admitted the batch can release it.
+
+    Required:
+        items (arg): Iterable of hashable items
+        size (arg): Function returning the bytes an item will read
+        workers (arg): Number of workers the batches are shared among
+
+    Optional:
+        max_files (arg/kwarg): Most items in a batch. At most an Executor's
+                               queue_depth
+    """
+
+    def __init__(self, items, size, workers, max_files=BATCH_FILES):
+        self.items = sorted(items, key=size, reverse=True)
+        self.size = size
+        self.workers = max(workers, 1)
+        self.max_files = max(max_files, 1)
+        self.pending = {}  # Items not yet done by batch
+        self.batch_of = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        remaining = sum(map(self.size, self.items))
+        batch, nbytes = [], 0
+        for item in self.items:
+            size = self.size(item)
+            target = min(
+                max(
+                    remaining // (self.workers * GUIDED_FACTOR),
+                    MIN_BATCH_BYTES
+                ),
+                MAX_BATCH_BYTES
+            )
+            remaining -= size
+            if size >= target:
+                if batch:
+                    yield self.track(batch)
+                    batch, nbytes = [], 0
+                yield self.track([item])
+                continue
+            batch.append(item)
+            nbytes += size
+            if nbytes >= target or len(batch) >= self.max_files:
+                yield self.track(batch)
+                batch, nbytes = [], 0
+        if batch:
+            yield self.track(batch)
+
+    def track(self, items):
+        batch = tuple(items)
+        self.pending[batch] = len(batch)
+        for item in batch:
+            self.batch_of[item] = batch
+        return batch
+
+    def done(self, item):
+        """Returns the batch of item if it was the last one left, else None"""
+        batch = self.batch_of.pop(item)
+        self.pending[batch] -= 1
+        if self.pending[batch]:
+            return None
+        del self.pending[batch]
+        return batch
+
+
+class MemoryBudget:
+    """Admission control for the bytes held by files in flight. Each item
+    let through admit holds cost(item) bytes of limit until release(item) is
+    called and admit blocks while the next item doesn't fit. An item costing
+    more than limit is only let in alone. With no limit, items go straight
+    through.
+
+    Optional:
+        limit (arg/kwarg): Bytes that the items in flight may hold
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.cond = Condition()
+        self.held = {}
+        self.used = 0
+        self.peak = 0
+
+    def admit(self, items, cost, cancelled):
+        """Iterator over items that blocks until each one fits, stopping
+        early once cancelled() is True. Runs in the pool's task handler
+        thread.
+
+        Required:
+            items (arg): Iterable of hashable items
+            cost (arg): Function returning the bytes an item will hold
+            cancelled (arg): Function returning True once the pool is closed
+        """
+        if self.limit is None:
+            yield from items
+            return
+        for item in items:
+            nbytes = min(cost(item), self.limit)
+            with self.cond:
+                while self.used and self.used + nbytes > self.limit:
+                    if cancelled():
+                        return
+                    self.cond.wait(0.1)
+                self.held[item] = nbytes
+                self.used += nbytes
+                self.peak = max(self.peak, self.used)
+            if (recorder := metrics.recorder()) is not None:
+                recorder.gauge('budget_bytes', self.used)
+            yield item
+
+    def release(self, item):
+        """Gives back the bytes held by item, if admit let it through"""
+        if self.limit is None:
+            return
+        with self.cond:
+            self.used -= self.held.pop(item, 0)
+            self.cond.notify_all()
+
+
+def probe(sample, hash_factory=None):
+    """Returns the mode for an Executor by comparing how fast up to
+    PROBE_FILES files from sample can be read against how fast the same
+    bytes can be hashed on one core.
+
+        'threads' if reading is slower than hashing
+        'hybrid' if each file takes over PROBE_LATENCY to start reading
+        'processes' otherwise
+
+    Required:
+        sample (arg): Iterable of filepaths
+
+    Optional:
+        hash_factory (arg/kwarg): Hash constructor. Defaults to hashlib.md5
+    """
+    if hash_factory is None:
+        hash_factory = hashlib.md5
+    read_seconds, latency, chunks = 0, 0, []
+    files = 0
+    for fpath in sample:
+        if files >= PROBE_FILES or sum(map(len, chunks)) >= PROBE_BYTES:
+            break
+        start = time.perf_counter()
+        try:
+            with open(fpath, 'rb') as f:
+                chunk = f.read(64 * 1024)
+                latency += time.perf_counter() - start
+                chunk += f.read(1024 * 1024 - len(chunk))
+        except OSError:
+            continue
+        read_seconds += time.perf_counter() - start
+        chunks.append(chunk)
+        files += 1
+    if not files:
+        return 'processes'
+    start = time.perf_counter()
+    f_hash = hash_factory()
+    for chunk in chunks:
+        f_hash.update(chunk)
+    hash_seconds = time.perf_counter() - start
+    if read_seconds > hash_seconds:
+        return 'threads'
+    if latency / files > PROBE_LATENCY:
+        return 'hybrid'
+    return 'processes'
+
+
+def warm(fpath):
+    """Reads fpath into a discarded buffer so it is in the page cache when a
+    hashing process opens it. Returns fpath.
+    """
+    view = getattr(buffers, 'view', None)
+    if view is None:
+        view = buffers.view = memoryview(bytearray(1024 * 1024))
+    try:
+        with open(fpath, 'rb', buffering=0) as f:
+            while f.readinto(view):
+                pass
+    except OSError:
+        pass  # Reported by the hashing process
+    return fpath
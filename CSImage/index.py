@@ -0,0 +1,116 @@
+import os
+
+
+SCHEMA_VERSION = 2
+UPDATE_SQL = '''INSERT OR REPLACE INTO file_index
+    (path, inode, size, mtime_ns, algorithm, hash)
+    VALUES (?, ?, ?, ?, ?, ?);
+'''
+
+
+def setup_index(cur):
+    """Creates the on-disk file_index table, rebuilding it if it was written
+    by a different SCHEMA_VERSION. The index is only a cache of hashes so
+    nothing is lost by rebuilding it. Hashes are stored per algorithm so a
+    lookup never returns a hash made by a different algorithm.
+
+    Required:
+        cur (arg): A cursor for an on-disk SQLite DB
+    """
+    cur.execute('PRAGMA journal_mode=WAL;')
+    cur.execute('PRAGMA synchronous=NORMAL;')
+    version = cur.execute('PRAGMA user_version;').fetchone()[0]
+    if version != SCHEMA_VERSION:
+        cur.execute('DROP TABLE IF EXISTS file_index;')
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS file_index(
+            path TEXT NOT NULL,
+            inode INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            algorithm TEXT NOT NULL,
+            hash BLOB NOT NULL,
+            PRIMARY KEY (path, algorithm)
+        );'''
+    )
+    cur.execute(f'PRAGMA user_version = {SCHEMA_VERSION:d};')
+    cur.execute('CREATE TEMP TABLE seen_paths(path TEXT PRIMARY KEY);')
+
+
+def index_key(fpath, st):
+    """Returns a tuple of (path, inode, size, mtime_ns) used to look up a file
+
+    Required:
+        fpath (arg): A filepath or a PathLike object
+        st (arg): The os.stat_result for fpath
+    """
+    return os.path.abspath(fpath), st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def lookup(cur, key, algorithm):
+    """Returns the stored hash for the file if it has not changed since it
+    was indexed with algorithm, else None
+
+    Required:
+        cur (arg): A cursor for a DB set up with setup_index
+        key (arg): A tuple from index_key
+        algorithm (arg): Name of the hash algorithm
+    """
+    cur.execute(
+        '''SELECT hash FROM file_index
+            WHERE path = (?) AND inode = (?) AND size = (?) AND mtime_ns = (?)
+            AND algorithm = (?);
+        ''',
+        (*key, algorithm)
+    )
+    if row := cur.fetchone():
+        return row[0]
+    return None
+
+
+def update(cur, key, algorithm, f_hash):
+    """Stores the hash for the file, replacing any previous entry for the
+    same algorithm
+
+    Required:
+        cur (arg): A cursor for a DB set up with setup_index
+        key (arg): A tuple from index_key
+        algorithm (arg): Name of the hash algorithm
+        f_hash (arg): The file's hash
+    """
+    cur.execute(UPDATE_SQL, (*key, algorithm, f_hash))
+
+
+def mark_seen(cur, keys):
+    """Records the paths found during this scan for prune
+
+    Required:
+        cur (arg): A cursor for a DB set up with setup_index
+        keys (arg): Iterable of tuples from index_key
+    """
+    cur.executemany(
+        'INSERT OR IGNORE INTO seen_paths (path) VALUES (?);',
+        ((key[0],) for key in keys)
+    )
+
+
+def prune(cur, cwd):
+    """Removes the entries under cwd that were not seen during this scan.
+
+    returns the number of entries removed
+
+    Required:
+        cur (arg): A cursor for a DB set up with setup_index
+        cwd (arg): The starting location that was scanned
+    """
+    prefix = os.path.join(os.path.abspath(cwd), '')
+    cur.execute(
+        '''DELETE FROM file_index
+            WHERE substr(path, 1, ?) = (?)
+            AND path NOT IN (SELECT path FROM seen_paths);
+        ''',
+        (len(prefix), prefix)
+    )
+    pruned = cur.rowcount
+    cur.execute('DELETE FROM seen_paths;')
+    return pruned
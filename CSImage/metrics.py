@@ -0,0 +1,244 @@
+import json
+import time
+
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock, local
+
+
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)  # Seconds, upper bounds of the latency histogram buckets
+PREFIX = 'csimage'
+QUANTILES = (0.5, 0.95, 0.99)
+
+current = None  # The Metrics for this process, None while disabled
+workers = local()  # Per call Metrics set by Instrumented
+
+
+class Metrics:
+    """Counters, gauges and per-stage latency histograms.
+
+    Counters are totals (files, bytes), gauges keep their last and largest
+    value (queue depths) and histograms record how long each call of a stage
+    took. Everything is guarded by a lock so threads can share one instance.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.perf_counter()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self.lock:
+            _, peak = self.gauges.get(name, (value, value))
+            self.gauges[name] = (value, max(peak, value))
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if (histogram := self.histograms.get(stage)) is None:
+                histogram = self.histograms[stage] = [
+                    [0] * (len(BUCKETS) + 1), 0, 0.0
+                ]
+            histogram[0][bisect_left(BUCKETS, seconds)] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def timer(self, stage):
+        """Returns a context manager that observes the time spent in it"""
+        return Timer(self, stage)
+
+    def merge(self, sample):
+        """Adds the counters and histograms from another Metrics' to_dict"""
+        for name, value in sample['counters'].items():
+            self.inc(name, value)
+        with self.lock:
+            for name, (value, peak) in sample['gauges'].items():
+                _, old_peak = self.gauges.get(name, (value, peak))
+                self.gauges[name] = (value, max(peak, old_peak))
+            histograms = sample['histograms']
+            for stage, (buckets, count, total) in histograms.items():
+                if (histogram := self.histograms.get(stage)) is None:
+                    histogram = self.histograms[stage] = [
+                        [0] * (len(BUCKETS) + 1), 0, 0.0
+                    ]
+                for idx, bucket in enumerate(buckets):
+                    histogram[0][idx] += bucket
+                histogram[1] += count
+                histogram[2] += total
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {
+                    stage: [list(buckets), count, total]
+                    for stage, (buckets, count, total)
+                    in self.histograms.items()
+                },
+            }
+
+    def summary(self):
+        """Returns a JSON friendly dict with per-second rates for every
+        counter and the count, total, mean and QUANTILES seconds of every
+        stage, see quantile
+        """
+        elapsed = time.perf_counter() - self.started
+        sample = self.to_dict()
+        return {
+            'elapsed_seconds': elapsed,
+            'counters': sample['counters'],
+            'rates': {
+                f'{name}_per_second': value / elapsed
+                for name, value in sample['counters'].items()
+            },
+            'gauges': {
+                name: {'last': value, 'max': peak}
+                for name, (value, peak) in sample['gauges'].items()
+            },
+            'stages': {
+                stage: {
+                    'count': count,
+                    'seconds': total,
+                    'mean_seconds': total / count if count else 0,
+                    **{
+                        f'p{round(q * 100)}_seconds': quantile(buckets, q)
+                        for q in QUANTILES
+                    },
+                    'buckets': dict(
+                        zip([*map(str, BUCKETS), '+Inf'], buckets)
+                    ),
+                }
+                for stage, (buckets, count, total)
+                in sample['histograms'].items()
+            },
+        }
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        sample = self.to_dict()
+        lines = []
+        for name, value in sorted(sample['counters'].items()):
+            lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+            lines.append(f'{PREFIX}_{name}_total {value}')
+        for name, (value, peak) in sorted(sample['gauges'].items()):
+            lines.append(f'# TYPE {PREFIX}_{name} gauge')
+            lines.append(f'{PREFIX}_{name} {value}')
+            lines.append(f'# TYPE {PREFIX}_{name}_max gauge')
+            lines.append(f'{PREFIX}_{name}_max {peak}')
+        name = f'{PREFIX}_stage_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for stage, (buckets, count, total) in sorted(
+            sample['histograms'].items()
+        ):
+            cumulative = 0
+            for bound, bucket in zip([*map(str, BUCKETS), '+Inf'], buckets):
+                cumulative += bucket
+                lines.append(
+                    f'{name}_bucket{{stage="{stage}",le="{bound}"}} '
+                    f'{cumulative}'
+                )
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, fpath):
+        """Writes the metrics to fpath, in the Prometheus text format if it
+        ends with .prom, else as JSON
+        """
+        with open(fpath, 'w') as f:
+            if fpath.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.summary(), f, indent=2)
+
+
+class Timer:
+
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+class Instrumented:
+    """Wraps a pool worker function so each call records into its own
+    Metrics and returns a tuple of (result, to_dict()) for the parent to
+    merge. The call itself is observed under the function's name and its
+    duration is also returned as the sample's 'seconds'.
+
+    Required:
+        func (arg): The worker function
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.stage = getattr(func, 'func', func).__name__
+
+    def __call__(self, item):
+        workers.metrics = recorder = Metrics()
+        start = time.perf_counter()
+        try:
+            result = self.func(item)
+        finally:
+            workers.metrics = None
+        seconds = time.perf_counter() - start
+        recorder.observe(self.stage, seconds)
+        sample = recorder.to_dict()
+        sample['seconds'] = seconds
+        return result, sample
+
+
+def quantile(buckets, q):
+    """Returns the upper bound of the histogram bucket holding the q
+    quantile, which overestimates it by at most one bucket, else None if it
+    falls in the +Inf bucket or there are no observations
+
+    Required:
+        buckets (arg): Observation counts per bucket of BUCKETS and +Inf
+        q (arg): The quantile, between 0 and 1
+    """
+    count = sum(buckets)
+    if not count:
+        return None
+    cumulative = 0
+    for bound, bucket in zip(BUCKETS, buckets):
+        cumulative += bucket
+        if cumulative >= q * count:
+            return bound
+    return None
+
+
+def enable():
+    """Starts recording metrics in this process and returns the Metrics"""
+    global current
+    current = Metrics()
+    return current
+
+
+def disable():
+    global current
+    current = None
+
+
+def recorder():
+    """Returns the Metrics to record into, else None if disabled. Inside an
+    Instrumented call that is the call's own Metrics.
+    """
+    return getattr(workers, 'metrics', None) or current
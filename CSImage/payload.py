@@ -0,0 +1,142 @@
+import io
+import os
+
+
+JPEG_EOI = b'\xff\xd9'
+JPEG_SOI = b'\xff\xd8'
+JPEG_SOS = 0xda
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_KEPT = {b'tRNS'}  # Ancillary chunks that change the pixels
+
+
+def hash_payload(f, f_hash, view):
+    """Updates f_hash with only the image data of the JPEG or PNG in f, so
+    copies that differ only in their metadata hash the same. Anything else
+    is hashed in full, as is a JPEG or PNG whose structure can't be parsed.
+
+    JPEGs keep every marker segment except APPn (EXIF, XMP, ICC, ...) and
+    COM, and everything from the first SOS up to EOI. PNGs keep the data of
+    the critical chunks (IHDR, PLTE, IDAT, IEND) and PNG_KEPT, skipping the
+    text, time and other ancillary chunks.
+
+    Returns f_hash, which is a fresh copy if parsing failed part way.
+
+    Required:
+        f (arg): A binary file object positioned at the start of the file
+        f_hash (arg): A new hashlib hash object
+        view (arg): A memoryview of a bytearray to read through
+    """
+    if isinstance(f, io.RawIOBase):
+        # Marker and chunk headers are only a few bytes each
+        buffered = io.BufferedReader(f)
+        try:
+            return hash_payload(buffered, f_hash, view)
+        finally:
+            buffered.detach()
+    start = f.tell()
+    pristine = f_hash.copy()
+    head = f.read(len(PNG_SIGNATURE))
+    try:
+        if head.startswith(JPEG_SOI):
+            f.seek(start + len(JPEG_SOI))
+            hash_jpeg(f, f_hash, view)
+            return f_hash
+        if head == PNG_SIGNATURE:
+            hash_png(f, f_hash, view)
+            return f_hash
+    except ValueError:
+        f_hash = pristine
+    f.seek(start)
+    while size := f.readinto(view):
+        f_hash.update(view[:size])
+    return f_hash
+
+
+def hash_jpeg(f, f_hash, view):
+    while True:
+        if read_exact(f, 1) != b'\xff':
+            raise ValueError('Expected a JPEG marker')
+        while (code := read_exact(f, 1)[0]) == 0xff:
+            pass  # Fill bytes
+        if code == 0x01 or 0xd0 <= code <= 0xd7:
+            f_hash.update(bytes((0xff, code)))  # No length
+            continue
+        if code == JPEG_EOI[1]:
+            f_hash.update(JPEG_EOI)
+            return
+        length = read_exact(f, 2)
+        remaining = int.from_bytes(length, 'big') - 2
+        if remaining < 0:
+            raise ValueError('Bad JPEG segment length')
+        if 0xe0 <= code <= 0xef or code == 0xfe:  # APPn or COM
+            f.seek(remaining, os.SEEK_CUR)
+            continue
+        f_hash.update(bytes((0xff, code)) + length)
+        copy(f, f_hash, view, remaining)
+        if code == JPEG_SOS:
+            hash_scans(f, f_hash, view)
+            return
+
+
+def hash_scans(f, f_hash, view):
+    """Hashes the entropy-coded data, and any later scans of a progressive
+    JPEG, up to and including EOI. Anything appended after EOI is skipped.
+    Files that end with EOI, nearly all of them, are hashed to the end
+    without searching for it.
+    """
+    position = f.tell()
+    end = f.seek(0, os.SEEK_END)
+    if end - position >= len(JPEG_EOI):
+        f.seek(end - len(JPEG_EOI))
+        ends_with_eoi = f.read(len(JPEG_EOI)) == JPEG_EOI
+    else:
+        ends_with_eoi = False
+    f.seek(position)
+    if ends_with_eoi:
+        copy(f, f_hash, view, end - position)
+        return
+    buffer = view.obj
+    trailing_ff = False
+    while size := f.readinto(view):
+        if trailing_ff and buffer[0] == JPEG_EOI[1]:
+            f_hash.update(view[:1])
+            return
+        if (end := buffer.find(JPEG_EOI, 0, size)) != -1:
+            f_hash.update(view[:end + len(JPEG_EOI)])
+            return
+        f_hash.update(view[:size])
+        trailing_ff = buffer[size - 1] == 0xff
+
+
+def hash_png(f, f_hash, view):
+    while True:
+        header = read_exact(f, 8)
+        length = int.from_bytes(header[:4], 'big')
+        chunk_type = header[4:]
+        if chunk_type[0] & 0x20 and chunk_type not in PNG_KEPT:
+            f.seek(length + 4, os.SEEK_CUR)  # Ancillary, skip it and the CRC
+            continue
+        if chunk_type != b'IDAT':
+            # IDAT is hashed as one stream however the encoder split it
+            f_hash.update(chunk_type)
+        copy(f, f_hash, view, length)
+        read_exact(f, 4)  # CRC
+        if chunk_type == b'IEND':
+            return
+
+
+def copy(f, f_hash, view, length):
+    """Updates f_hash with the next length bytes of f"""
+    while length:
+        size = f.readinto(view[:min(length, len(view))])
+        if not size:
+            raise ValueError('Unexpected end of file')
+        f_hash.update(view[:size])
+        length -= size
+
+
+def read_exact(f, length):
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError('Unexpected end of file')
+    return data
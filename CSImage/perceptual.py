@@ -0,0 +1,318 @@
+import os
+
+from functools import cache, partial
+from io import BytesIO
+from itertools import combinations
+from math import comb
+from multiprocessing import Pool
+
+from search import INLINE_MAX_BYTES, ImageData, Match, crawl
+
+
+HASH_SIZE = 8  # 8x8 = 64 bit hashes
+FLIPS_CACHED = 4096
+
+
+class BKTree:
+    """A BK-tree of perceptual hashes keyed on Hamming distance.
+
+    Lookups only descend into children whose edge distance is within
+    max_distance of the query's distance to the node, so a query touches a
+    small fraction of the tree instead of every hash added to it.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, p_hash, fpath):
+        """Adds the hash and the filepath it belongs to
+
+        Required:
+            p_hash (arg): The perceptual hash as an int
+            fpath (arg): A filepath or a PathLike object
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = (p_hash, fpath, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(p_hash, node[0])
+            children = node[2]
+            if distance not in children:
+                children[distance] = (p_hash, fpath, {})
+                return
+            node = children[distance]
+
+    def find(self, p_hash, max_distance):
+        """Returns a Match for the closest hash within max_distance, else None
+
+        Required:
+            p_hash (arg): The perceptual hash as an int
+            max_distance (arg): The largest Hamming distance considered a match
+        """
+        if self.root is None:
+            return None
+        best = None
+        nodes = [self.root]
+        while nodes:
+            node_hash, node_fpath, children = nodes.pop()
+            distance = hamming_distance(p_hash, node_hash)
+            if distance <= max_distance:
+                if best is None or distance < best.distance:
+                    best = Match(node_fpath, distance)
+                    if distance == 0:
+                        return best
+            low, high = distance - max_distance, distance + max_distance
+            nodes.extend(
+                child
+                for edge, child in children.items()
+                if low <= edge <= high
+            )
+        return best
+
+
+class MultiIndex:
+    """Multi-index hashing of perceptual hashes, which answers the lookups
+    of a BKTree without comparing the query with most of the hashes.
+
+    Every hash is filed under each of its blocks slices of bits. If slice i
+    of a hash differs from the query's in more than limit i bits, the whole
+    hash differs in at least sum(limits) + blocks bits, so with limits
+    summing to max_distance - blocks + 1 a hash within max_distance has at
+    least one slice within its limit. Only the hashes filed under slices
+    that close to the query's are compared. Hashes that are spread out, as
+    those of a large library are, leave a BKTree little to prune, while
+    each slice lookup here finds about len / 2 ** (64 // blocks) hashes.
+
+    The slice lookups grow combinatorially with max_distance, so a lookup
+    that would take more of them than there are hashes compares every hash
+    instead. Each filepath holds one hash, adding it again replaces it.
+
+    Optional:
+        blocks (arg/kwarg): Number of slices. Around 64 / log2(len) keeps
+                            both the slice lookups and the hashes compared
+                            few, 3 suits a million hashes
+    """
+
+    def __init__(self, blocks=3):
+        bits = HASH_SIZE * HASH_SIZE
+        if not 1 <= blocks <= bits:
+            raise ValueError(f'blocks must be between 1 and {bits}')
+        bounds = [bits * idx // blocks for idx in range(blocks + 1)]
+        self.slices = [
+            (start, end - start) for start, end in zip(bounds, bounds[1:])
+        ]
+        self.tables = [{} for _ in self.slices]
+        self.hashes = []
+        self.fpaths = []
+        self.ids = {}  # Position in hashes and fpaths by filepath
+        self.free = []  # Positions of removed hashes, reused by add
+
+    def __len__(self):
+        return len(self.ids)
+
+    def keys(self, p_hash):
+        """Iterator that yields a tuple of (table, key) for every slice"""
+        for table, (shift, width) in zip(self.tables, self.slices):
+            yield table, (p_hash >> shift) & ((1 << width) - 1)
+
+    def add(self, p_hash, fpath):
+        """Adds the hash and the filepath it belongs to, replacing the hash
+        the filepath was added with before
+
+        Required:
+            p_hash (arg): The perceptual hash as an int
+            fpath (arg): A filepath or a PathLike object
+        """
+        self.remove(fpath)
+        if self.free:
+            idx = self.free.pop()
+            self.hashes[idx], self.fpaths[idx] = p_hash, fpath
+        else:
+            idx = len(self.hashes)
+            self.hashes.append(p_hash)
+            self.fpaths.append(fpath)
+        self.ids[fpath] = idx
+        for table, key in self.keys(p_hash):
+            table.setdefault(key, []).append(idx)
+
+    def remove(self, fpath):
+        """Removes the hash of the filepath. Returns False if it wasn't
+        added.
+        """
+        if (idx := self.ids.pop(fpath, None)) is None:
+            return False
+        for table, key in self.keys(self.hashes[idx]):
+            bucket = table[key]
+            bucket.remove(idx)
+            if not bucket:
+                del table[key]
+        self.hashes[idx] = self.fpaths[idx] = None
+        self.free.append(idx)
+        return True
+
+    def find(self, p_hash, max_distance):
+        """Returns a Match for the closest hash within max_distance, else None
+
+        Required:
+            p_hash (arg): The perceptual hash as an int
+            max_distance (arg): The largest Hamming distance (0-64) considered
+                                a match
+        """
+        bits = HASH_SIZE * HASH_SIZE
+        if (
+            not isinstance(max_distance, int)
+            or isinstance(max_distance, bool)
+            or not 0 <= max_distance <= bits
+        ):
+            raise ValueError(
+                f'max_distance must be an int between 0 and {bits}'
+            )
+        blocks = len(self.slices)
+        total = max_distance - blocks + 1
+        # Limits that sum to total, a negative one skips its slice
+        limits = [(total + idx) // blocks for idx in range(blocks)]
+        lookups = sum(
+            comb(width, flipped)
+            for (_, width), limit in zip(self.slices, limits)
+            for flipped in range(limit + 1)
+        )
+        if lookups >= len(self):
+            candidates = range(len(self.hashes))
+        else:
+            candidates = self.candidates(p_hash, limits)
+        best = None
+        for idx in candidates:
+            if (node_hash := self.hashes[idx]) is None:
+                continue
+            distance = hamming_distance(p_hash, node_hash)
+            if distance > max_distance:
+                continue
+            if best is None or distance < best.distance:
+                best = Match(self.fpaths[idx], distance)
+                if distance == 0:
+                    return best
+        return best
+
+    def candidates(self, p_hash, limits):
+        """Iterator that yields the position of every hash with a slice
+        within its limit of the query's, once each, closest slices first
+        """
+        compared = set()
+        for flipped in range(max(limits) + 1):
+            for (table, key), (_, width), limit in zip(
+                self.keys(p_hash), self.slices, limits
+            ):
+                if flipped > limit:
+                    continue
+                for flip in bit_flips(width, flipped):
+                    for idx in table.get(key ^ flip, ()):
+                        if idx not in compared:
+                            compared.add(idx)
+                            yield idx
+
+
+def bit_flips(width, flipped):
+    """Returns an iterable of every int of width bits with flipped bits set.
+    Those of up to FLIPS_CACHED ints are kept for the next lookup.
+    """
+    if comb(width, flipped) <= FLIPS_CACHED:
+        return cached_bit_flips(width, flipped)
+    return (
+        sum(1 << bit for bit in bits)
+        for bits in combinations(range(width), flipped)
+    )
+
+
+@cache
+def cached_bit_flips(width, flipped):
+    return tuple(
+        sum(1 << bit for bit in bits)
+        for bits in combinations(range(width), flipped)
+    )
+
+
+def process(cwd, img_types=None, max_distance=10, previews=True):
+    """Iterator that yields a tuple of (match, filepath, mem) for every image
+    found. match is False if the image was unique, else a Match of the
+    previously seen filepath it resembles and the Hamming distance between
+    their perceptual hashes.
+
+    Optional:
+        img_types (arg/kwarg): Array object containting exention types to use
+        max_distance (kwarg): The largest Hamming distance (0-64) considered
+                              a match
+        previews (kwarg): If False, mem is None for every result, else mem is
+                          an ImageData object
+    """
+    if img_types is None:
+        img_types = {'.jpg', '.jpeg', '.tiff', '.gif', '.png'}
+    tree = BKTree()
+    crawler = crawl(cwd, img_types)
+    pool_args = (partial(generate_dhash, previews=previews), crawler, 10)
+    with Pool() as pool:
+        for fpath, hash_result, mem in pool.imap_unordered(*pool_args):
+            if isinstance(hash_result, Exception):
+                yield False, fpath, mem  # Log
+            elif match := tree.find(hash_result, max_distance):
+                yield match, fpath, mem
+            else:
+                tree.add(hash_result, fpath)
+                yield False, fpath, mem
+
+
+def generate_dhash(fpath, previews=True):
+    """Returns a tuple of the filepath, a 64 bit difference hash (dHash) for
+    the specified image or an Exception, and an ImageData object for the file
+
+    Required:
+        fpath (arg): A filepath or a PathLike object
+
+    Optional:
+        previews (kwarg): If False, None is returned in place of the ImageData
+    """
+    from PIL import Image
+
+    try:
+        mem = ImageData(fpath)
+        if os.stat(fpath).st_size <= INLINE_MAX_BYTES:
+            with open(fpath, 'rb') as f:
+                mem.data = f.read()
+            img = Image.open(BytesIO(mem.data))
+        else:
+            img = Image.open(fpath)
+        with img:
+            p_hash = dhash(img)
+    except Exception as e:
+        return fpath, e, ImageData(fpath, b'') if previews else None
+    else:
+        return fpath, p_hash, mem if previews else None
+
+
+def dhash(img):
+    """Returns the 64 bit difference hash of a PIL Image as an int
+
+    Each bit records whether a pixel of the greyscale image, shrunk to
+    9x8, is brighter than its right hand neighbour.
+
+    Required:
+        img (arg): A PIL Image
+    """
+    width, height = HASH_SIZE + 1, HASH_SIZE
+    img.draft('L', (width * 4, height * 4))  # DCT scaling for JPEGs
+    pixels = list(img.convert('L').resize((width, height)).getdata())
+    p_hash = 0
+    for row in range(0, width * height, width):
+        for col in range(row, row + HASH_SIZE):
+            p_hash = (p_hash << 1) | (pixels[col] > pixels[col + 1])
+    return p_hash
+
+
+def hamming_distance(hash1, hash2):
+    """Returns the number of differing bits between two int hashes"""
+    return (hash1 ^ hash2).bit_count()
@@ -1,6 +1,7 @@
 import os
 import time
-import zlib
+
+from threading import Event
 
 from PySide6 import QtCore
 from PySide6.QtGui import QImage, QPixmap
@@ -15,14 +16,161 @@ from PySide6.QtWidgets import QApplication, \
                               QStackedWidget, \
                               QVBoxLayout, \
                               QWidget
-from search import process
+import metrics
+import watch
+
+from search import Scanner, process
+from thumbnails import ThumbnailCache
+
+
+BORDER_SIZE = 50
+FPS = 60
+MATCH_HOLD = .25  # Seconds a match stays on screen
+PROGRESS_INTERVAL = .1  # Seconds between progress updates
+
+
+class ScanSignals(QtCore.QObject):
+    """Signals sent from a ScanWorker to the GUI thread"""
+
+    image = QtCore.Signal(bool, QImage)  # is_match, decoded and scaled image
+    progress = QtCore.Signal(int, int)  # processed, matches
+    finished = QtCore.Signal(str, int, int)  # cwd, processed, matches
+
+
+class ScanWorker(QtCore.QRunnable):
+    """Runs a scan of cwd off the GUI thread and decodes and scales the images
+    to show, sending them back as QImages. Non-matches are decoded at most
+    FPS times a second and matches once every MATCH_HOLD seconds, the rest
+    are only counted. Progress is sent at most every PROGRESS_INTERVAL.
+
+    args (required):
+        cwd - The starting location to process images in
+        index_path - Filepath of an on-disk index or None
+        thumbnails - ThumbnailCache to make the previews from or None
+        scanner - Scanner to run the scan on or None for a fresh pool
+        watching - If True, keeps watching cwd for new images after the scan
+                   until cancelled
+    """
+
+    def __init__(
+        self,
+        cwd,
+        index_path=None,
+        thumbnails=None,
+        scanner=None,
+        watching=False
+    ):
+        super().__init__()
+        self.cwd = cwd
+        self.scanner = scanner
+        self.watching = watching
+        self.index_path = index_path
+        self.thumbnails = thumbnails
+        self.signals = ScanSignals()
+        self.target_size = (0, 0)  # Set by the GUI thread on resize
+        self.resumed = Event()
+        self.resumed.set()
+        self.cancelled = Event()
+
+    def run(self):
+        processed, matches = 0, 0
+        next_frame, next_match, next_progress = 0, 0, 0
+        if self.watching:
+            results = watch.process(
+                self.cwd,
+                index_path=self.index_path,
+                stop=self.cancelled,
+                executor='processes' if self.scanner is None else (
+                    self.scanner.executor
+                )
+            )
+        else:
+            scan = process if self.scanner is None else self.scanner.process
+            results = scan(self.cwd, index_path=self.index_path)
+        try:
+            for is_match, _, mem in results:
+                self.resumed.wait()
+                if self.cancelled.is_set():
+                    break
+                if is_match:
+                    matches += 1
+                processed += 1
+                now = time.monotonic()
+                if is_match and now >= next_match:
+                    next_match = now + MATCH_HOLD
+                    next_frame = next_match
+                    self.send_image(is_match, mem)
+                elif not is_match and now >= next_frame:
+                    next_frame = now + 1 / FPS
+                    self.send_image(is_match, mem)
+                if now >= next_progress:
+                    next_progress = now + PROGRESS_INTERVAL
+                    self.signals.progress.emit(processed, matches)
+        finally:
+            results.close()
+            self.signals.finished.emit(self.cwd, processed, matches)
+
+    def send_image(self, is_match, mem):
+        if self.thumbnails is not None:
+            mem = self.thumbnails.preview(mem, self.target_size)
+        if (recorder := metrics.recorder()) is not None:
+            with recorder.timer('render'):
+                image = decode_image(is_match, mem, *self.target_size)
+        else:
+            image = decode_image(is_match, mem, *self.target_size)
+        if image is not None:
+            self.signals.image.emit(bool(is_match), image)
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.resumed.set()
+
+
+def decode_image(is_match, mem, widget_width, widget_height):
+    """Returns a QImage of mem scaled to fit the carousel, else None if it
+    can't be decoded
+
+    args (required):
+        is_match - boolean for if the image is a match
+        mem - An ImageData object for the image
+        widget_width - Width of the carousel widget
+        widget_height - Height of the carousel widget
+    """
+    image = QImage()
+    if not image.loadFromData(mem.read()):
+        return None
+    width, height = image.width(), image.height()
+    widget_width -= BORDER_SIZE
+    widget_height -= BORDER_SIZE
+    if is_match:
+        widget_width = widget_width // 2
+        widget_height = widget_height // 2
+    if height > widget_height or width > widget_width:
+        image = image.scaled(
+                widget_width, widget_height,
+                aspectMode=QtCore.Qt.KeepAspectRatio
+            )
+    return image
 
 
 class MainWindow(QMainWindow):
 
-    def __init__(self, parent=None):
+    def __init__(
+        self, parent=None, index_path=None, thumbnails=None, watching=False
+    ):
         super().__init__(parent)
+        self.index_path = index_path
+        self.thumbnails = thumbnails
+        self.watching = watching
+        self.scanner = Scanner()  # Keeps the pool warm across restarts
         self.threadpool = QtCore.QThreadPool()
+        self.worker = None
         self.resize(600, 350)
         self.carousel_widget = None
         self.results_widget = None
@@ -47,56 +195,87 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(self.main_widget)
 
     def run(self, cwd):
-        """Initiates the processing of images and sets off the carousel
+        """Initiates the processing of images on a ScanWorker and sets off
+        the carousel
 
         args (required):
             cwd - The starting location where the images were processed
         """
         self.main_widget.setCurrentWidget(self.carousel_widget)
-        processed, matches = 0, 0
-        self.update_progress_status(processed=processed, matches=matches)
-        for is_match, _, mem in process(cwd):
-            if is_match:
-                matches += 1
-            processed += 1
-            self.spin_the_carousel(is_match, mem)
-            self.update_progress_status(processed=processed, matches=matches)
-            QApplication.processEvents()
-            if is_match:
-                time.sleep(.25)
-        self.show_results(cwd, processed, matches)
+        self.update_progress_status(processed=0, matches=0)
+        self.pause_btn.setText('Pause')
+        self.worker = ScanWorker(
+            cwd,
+            index_path=self.index_path,
+            thumbnails=self.thumbnails,
+            scanner=self.scanner,
+            watching=self.watching
+        )
+        self.worker.target_size = self.carousel_size()
+        self.worker.signals.image.connect(self.spin_the_carousel)
+        self.worker.signals.progress.connect(self.on_progress)
+        self.worker.signals.finished.connect(self.on_finished)
+        self.threadpool.start(self.worker)
 
-    def spin_the_carousel(self, is_match, mem):
+    @QtCore.Slot(bool, QImage)
+    def spin_the_carousel(self, is_match, image):
         """Spins the carousel to add the necessary images.
 
         args (required)
             is_match - boolean for if the image is a match
-            mem - A zlib compressed binary object for the image
+            image - A QImage already scaled to fit the carousel
         """
-        border_size = 50
-        image = QImage()
-        if image.loadFromData(zlib.decompress(mem)):
-            width, height = image.width(), image.height()
-            widget_width = self.carousel_widget.width() - border_size
-            widget_height = self.carousel_widget.height() - border_size
-            if is_match:
-                widget_width = widget_width // 2
-                widget_height = widget_height // 2
-            if height > widget_height or width > widget_width:
-                image = image.scaled(
-                        widget_width, widget_height,
-                        aspectMode=QtCore.Qt.KeepAspectRatio
-                    )
-            pixmap = QPixmap.fromImage(image)
-            if is_match:
-                self.non_match_widget.setVisible(False)
-                self.match_widget.setVisible(True)
-                self.match_image1.setPixmap(pixmap)
-                self.match_image2.setPixmap(pixmap)
-            else:
-                self.match_widget.setVisible(False)
-                self.non_match_widget.setVisible(True)
-                self.non_match_image.setPixmap(pixmap)
+        pixmap = QPixmap.fromImage(image)
+        if is_match:
+            self.non_match_widget.setVisible(False)
+            self.match_widget.setVisible(True)
+            self.match_image1.setPixmap(pixmap)
+            self.match_image2.setPixmap(pixmap)
+        else:
+            self.match_widget.setVisible(False)
+            self.non_match_widget.setVisible(True)
+            self.non_match_image.setPixmap(pixmap)
+
+    @QtCore.Slot(int, int)
+    def on_progress(self, processed, matches):
+        self.update_progress_status(processed=processed, matches=matches)
+
+    @QtCore.Slot(str, int, int)
+    def on_finished(self, cwd, processed, matches):
+        self.worker = None
+        self.show_results(cwd, processed, matches)
+
+    @QtCore.Slot()
+    def toggle_pause(self):
+        """Pauses or resumes the running scan"""
+        if self.worker is None:
+            return
+        if self.worker.resumed.is_set():
+            self.worker.pause()
+            self.pause_btn.setText('Resume')
+        else:
+            self.worker.resume()
+            self.pause_btn.setText('Pause')
+
+    @QtCore.Slot()
+    def cancel(self):
+        """Stops the running scan and shows the results so far"""
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def carousel_size(self):
+        return self.carousel_widget.width(), self.carousel_widget.height()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.worker is not None:
+            self.worker.target_size = self.carousel_size()
+
+    def closeEvent(self, event):
+        self.cancel()
+        self.threadpool.waitForDone()
+        self.scanner.close()
+        super().closeEvent(event)
 
     def show_results(self, cwd, processed, matches):
         """Shows the results in the results widget.
@@ -166,10 +345,22 @@ class MainWindow(QMainWindow):
         non_match_layout.addWidget(self.non_match_image)
         non_match_widget.setLayout(non_match_layout)
 
+        self.pause_btn = QPushButton('Pause')
+        self.pause_btn.clicked.connect(self.toggle_pause)
+        cancel_btn = QPushButton('Cancel')
+        cancel_btn.clicked.connect(self.cancel)
+        btn_layout = QHBoxLayout()
+        btn_layout.setSpacing(5)
+        btn_layout.addStretch()
+        btn_layout.addWidget(self.pause_btn)
+        btn_layout.addWidget(cancel_btn)
+        btn_layout.addStretch()
+
         layout = QVBoxLayout()
         layout.setAlignment(QtCore.Qt.AlignCenter)
         layout.addWidget(match_widget)
         layout.addWidget(non_match_widget)
+        layout.addLayout(btn_layout)
 
         self.carousel_widget = QWidget()
         self.carousel_widget.setLayout(layout)
@@ -225,9 +416,46 @@ class MainWindow(QMainWindow):
 
 
 if __name__ == '__main__':
+    import argparse
     import sys
 
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--index', help='Filepath of an on-disk index to reuse between scans'
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Filepath to write stage metrics to on exit, as Prometheus '
+             'text if it ends with .prom else JSON'
+    )
+    parser.add_argument(
+        '--thumbnails',
+        help='Directory of the thumbnail cache shared by the front-ends'
+    )
+    parser.add_argument(
+        '--no-thumbnails',
+        action='store_true',
+        help='Decode the original images instead of cached thumbnails'
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep watching the selected folder after the scan and show new '
+             'images as they are written'
+    )
+    args, qt_args = parser.parse_known_args()
+    if args.metrics:
+        metrics.enable()
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = MainWindow(
+        index_path=args.index,
+        thumbnails=None if args.no_thumbnails else ThumbnailCache(
+            args.thumbnails
+        ),
+        watching=args.watch
+    )
     window.show()
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    if args.metrics:
+        metrics.current.write(args.metrics)
+    sys.exit(exit_code)
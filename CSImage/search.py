@@ -1,10 +1,247 @@
 import hashlib
+import multiprocessing
 import os
 import sqlite3
-import zlib
+import sys
+import time
 
-from multiprocessing import Pool
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from functools import partial
+from operator import attrgetter
+from io import BytesIO
 from queue import Queue
+from threading import Event, Lock, local
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+import index
+import metrics
+import payload
+import transport
+
+from executors import (
+    BATCH_FILES, QUEUE_DEPTH, Executor, MemoryBudget, Schedule
+)
+
+
+ALGORITHMS = {
+    'blake2b': partial(hashlib.blake2b, digest_size=16),
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+}
+BATCH_SIZE = 1000
+CHUNK_SIZE = 1024 * 1024
+INLINE_MAX_BYTES = 256 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+PARTIAL_BLOCK_SIZE = 64 * 1024
+PREVIEW_DECODE_FACTOR = 8  # Bytes decoded for a preview per byte of file
+PREVIEW_QUALITY = 85
+TREE_LEAF_BYTES = 64 * 1024 * 1024
+STAT_KEYS = (
+    'files',
+    'bytes',
+    'size_unique_files',
+    'size_skipped_bytes',
+    'partial_unique_files',
+    'partial_hashed_bytes',
+    'partial_skipped_bytes',
+    'full_hashed_bytes',
+    'index_hits',
+    'index_skipped_bytes',
+    'index_pruned',
+    'executor',
+    'workers',
+    'pool_seconds',
+    'bytes_per_second',
+    'tree_hashed_files',
+    'tail_seconds',
+    'worker_utilisation',
+    'peak_budget_bytes',
+    'peak_rss_bytes',
+    'peak_worker_rss_bytes',
+)
+
+Leaf = namedtuple('Leaf', ['fpath', 'offset', 'length'])
+Match = namedtuple('Match', ['fpath', 'distance'])
+Result = namedtuple(
+    'Result',
+    ['match', 'fpath', 'size', 'digest', 'mem', 'error'],
+    defaults=(None,)
+)
+
+buffers = local()  # Reused readinto buffers, one per thread
+
+
+class BatchWriter:
+    """Collects rows for an executemany statement and writes them in a single
+    transaction once batch_size rows are pending
+
+    Required:
+        con (arg): An SQLite connection
+        sql (arg): The statement to pass to executemany
+
+    Optional:
+        batch_size (arg/kwarg): Number of rows to collect before writing
+    """
+
+    def __init__(self, con, sql, batch_size=BATCH_SIZE):
+        self.con = con
+        self.sql = sql
+        self.batch_size = batch_size
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            if (recorder := metrics.recorder()) is not None:
+                recorder.inc('db_rows', len(self.rows))
+                with recorder.timer('db_write'), self.con:
+                    self.con.executemany(self.sql, self.rows)
+            else:
+                with self.con:
+                    self.con.executemany(self.sql, self.rows)
+            self.rows = []
+
+
+class SeenHashes:
+    """In-memory record of the first filepath seen for each digest. Digests
+    are checked against a dict rather than the DB. Only the on-disk index
+    outlives a scan, so the digests are persisted there by find.
+    """
+
+    def __init__(self):
+        self.first_seen = {}
+
+    def __len__(self):
+        return len(self.first_seen)
+
+    def check(self, digest, fpath):
+        """Returns a Match of the first filepath seen with digest, else
+        records fpath as the first and returns False
+
+        Required:
+            digest (arg): The file's digest as bytes
+            fpath (arg): A filepath or a PathLike object
+        """
+        if (recorder := metrics.recorder()) is not None:
+            with recorder.timer('lookup'):
+                original = self.first_seen.get(digest)
+        else:
+            original = self.first_seen.get(digest)
+        if original is not None:
+            return Match(original, 0)
+        self.first_seen[digest] = fpath
+        return False
+
+
+class ImageData:
+    """The image contents sent back from the workers. Files no larger than
+    INLINE_MAX_BYTES are carried inline, or in a slot of a SharedRing when
+    find uses one, larger files are only read from disk once the consumer
+    calls read().
+
+    Required:
+        fpath (arg): A filepath or a PathLike object
+
+    Optional:
+        data (arg/kwarg): The contents of fpath if already read
+        digest (arg/kwarg): The file's hash if it was hashed
+    """
+
+    __slots__ = ('fpath', 'data', 'digest', 'shared', 'ring')
+
+    def __init__(self, fpath, data=None, digest=None):
+        self.fpath = fpath
+        self.data = data
+        self.digest = digest
+        self.shared = None  # (slot, length) of the contents in self.ring
+        self.ring = None
+
+    def __del__(self):
+        self.release()
+
+    def read(self):
+        """Returns the contents of the image or b'' if it can't be read.
+        Contents in a SharedRing are copied out and the slot released.
+        """
+        if self.data is not None:
+            return self.data
+        if self.ring is not None:
+            with self.view() as view:
+                self.data = view.tobytes()
+            self.release()
+            return self.data
+        try:
+            with open(self.fpath, 'rb') as f:
+                return f.read()
+        except OSError:
+            return b''  # Log
+
+    def view(self):
+        """Returns a memoryview of the contents in the SharedRing without
+        copying them. Only valid until read() or release() is called.
+        """
+        return self.ring.view(*self.shared)
+
+    def release(self):
+        """Gives the SharedRing slot holding the contents, if any, back"""
+        if (ring := self.ring) is not None:
+            self.ring = None
+            ring.release(self.shared[0])
+
+
+class SharedTask(namedtuple('SharedTask', ('fpath', 'slot'))):
+    """A filepath sent to a pool worker with the SharedRing slot to write
+    its ImageData into. It is PathLike so stages that only open the file,
+    like executors.warm, take it as is.
+    """
+
+    __slots__ = ()
+
+    def __fspath__(self):
+        return os.fspath(self.fpath)
+
+
+class Shared:
+    """Wraps a pool worker function that returns a tuple holding an
+    ImageData so its inline contents are written into the task's slot of
+    the SharedRing called name and only (slot, length) is pickled back.
+    Calls with a SharedTask and returns a tuple of (slot, result).
+
+    Required:
+        func (arg): The worker function, called with the filepath
+        name (arg): The SharedRing's name
+        slot_size (arg): The SharedRing's slot_size
+    """
+
+    def __init__(self, func, name, slot_size):
+        self.target = func
+        self.name = name
+        self.slot_size = slot_size
+        self.__name__ = getattr(func, 'func', func).__name__
+
+    def __call__(self, task):
+        result = self.target(task.fpath)
+        if task.slot is None:
+            return None, result
+        for mem in result:
+            if isinstance(mem, ImageData) and mem.data:
+                if transport.write(
+                    self.name, task.slot, self.slot_size, mem.data
+                ):
+                    mem.shared = (task.slot, len(mem.data))
+                    mem.data = None
+                break
+        return task.slot, result
 
 
 class ImageQueue(Queue):
@@ -25,79 +262,1005 @@ class ImageQueue(Queue):
         self.put(self.SENTINEL)
 
 
-def process(cwd, img_types=None):
-    """Iterator that yields a tuple of (bool, filpath) if the image found
-    was unique or not.
+class FrameBuffer:
+    """Bounded hand-off of (match, fpath, mem) results from a scan to a
+    front-end that renders slower than the scan produces. put never blocks:
+    only the newest non-match is kept and up to size matches are queued, the
+    oldest being dropped once full. dropped counts the results discarded.
+
+    Optional:
+        size (arg/kwarg): Number of matches to keep
+    """
+
+    def __init__(self, size=8):
+        self.lock = Lock()
+        self.matches = deque(maxlen=size)
+        self.latest = None
+        self.dropped = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.matches) + (self.latest is not None)
+
+    def put(self, result):
+        with self.lock:
+            if result[0]:
+                if len(self.matches) == self.matches.maxlen:
+                    self.dropped += 1
+                self.matches.append(result)
+            else:
+                if self.latest is not None:
+                    self.dropped += 1
+                self.latest = result
+
+    def get(self):
+        """Returns the oldest queued match, else the newest non-match, else
+        None if nothing is waiting
+        """
+        with self.lock:
+            if self.matches:
+                return self.matches.popleft()
+            result, self.latest = self.latest, None
+            return result
+
+
+def process(cwd, *args, **kwargs):
+    """Iterator that yields a tuple of (match, filpath, mem) if the image found
+    was unique or not. match is False for unique images, else a Match of the
+    first filepath seen with the same contents.
+
+    Takes the same arguments as find
+    """
+    for result in find(cwd, *args, **kwargs):
+        yield result.match, result.fpath, result.mem
+
+
+class Scanner:
+    """Runs scans one after another on a single warm executors.Executor,
+    so only the first scan pays for starting the worker processes and the
+    imports in them. find and process take the same arguments as the
+    module level functions, less executor, workers and queue_depth. One
+    scan runs at a time, a second one started while another is being
+    iterated raises a RuntimeError.
+
+    The pool is shut down by close(), or on leaving a with block. With the
+    'forkserver' start method the server preloads this module, so each new
+    worker starts with it already imported.
+
+    Optional:
+        executor (arg/kwarg): One of executors.MODES. 'auto' is probed on
+                              the first scan
+        workers (kwarg): Number of worker processes or threads
+        queue_depth (kwarg): Largest number of files in flight at once
+        start_method (kwarg): multiprocessing start method of the worker
+                              processes, e.g. 'forkserver'. Defaults to the
+                              platform's
+    """
+
+    def __init__(
+        self,
+        executor='processes',
+        workers=None,
+        queue_depth=QUEUE_DEPTH,
+        start_method=None
+    ):
+        if start_method == 'forkserver':
+            multiprocessing.get_context(start_method).set_forkserver_preload(
+                [__name__]
+            )
+        self.executor = Executor(
+            executor,
+            workers=workers,
+            queue_depth=queue_depth,
+            persistent=True,
+            start_method=start_method
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def find(self, cwd, *args, **kwargs):
+        """Iterator that yields a Result for every image found, see find"""
+        return find(cwd, *args, executor=self.executor, **kwargs)
+
+    def process(self, cwd, *args, **kwargs):
+        """Iterator that yields a tuple of (match, filepath, mem), see
+        process
+        """
+        return process(cwd, *args, executor=self.executor, **kwargs)
+
+    def close(self):
+        self.executor.close()
+
+
+def find(
+    cwd,
+    img_types=None,
+    previews=True,
+    stats=None,
+    index_path=None,
+    algorithm='md5',
+    chunk_size=CHUNK_SIZE,
+    executor='processes',
+    workers=None,
+    queue_depth=QUEUE_DEPTH,
+    preview_size=None,
+    ring_slots=transport.SLOTS,
+    payload_only=False,
+    memory_limit=None,
+    tree_min_bytes=None,
+    hash_all=False,
+    **scan_kwargs
+):
+    """Iterator that yields a Result for every image found. match is False for
+    unique images, else a Match of the first filepath seen with the same
+    contents. digest is None for files found unique without a full hash and
+    error is a description of why the file could not be read, else None.
+
+    Candidates are narrowed down in stages so only files that could be
+    duplicates are ever hashed in full:
+        1. Files are grouped by size. A file with a unique size is unique.
+        2. Files sharing a size have their head and tail hashed. A unique
+           (size, partial hash) pair is unique.
+        3. Remaining files are hashed in full and checked against the DB.
+
+    When an index_path is given, files whose path, inode, size and mtime
+    match the saved index reuse the stored hash and are never reopened for
+    hashing. Files sharing a size with an indexed file skip stage 2. Once
+    the scan finishes, entries under cwd for files that no longer exist are
+    pruned, unless the crawl was narrowed with exclude or max_depth.
+
+    With payload_only, copies that differ only in their metadata differ in
+    size too, so stages 1 and 2 are skipped and every file is hashed. So
+    are they with hash_all, for results that are merged with other scans,
+    see shards.
+
+    With a memory_limit, the read buffers and SharedRing are shrunk to fit
+    and files are only sent to the pool while the bytes they will hold
+    (inline contents, a read buffer, the pixels decoded for a preview) fit
+    in what is left, so huge files are hashed one at a time, streaming.
+    The peak resident set sizes are reported in stats either way.
+
+    Full hashing is scheduled by size: files go out largest first, the
+    smaller ones packed into byte-balanced batches, see executors.Schedule.
+    With a tree_min_bytes, files at least that large are instead split into
+    leaves of TREE_LEAF_BYTES hashed in parallel, see tree_digest.
 
     Optional:
         img_types (arg/kwarg): Array object containting exention types to use
+        previews (kwarg): If False, image contents are never read for display
+                          and mem is None for every Result, else mem is an
+                          ImageData object
+        stats (kwarg): dict that is updated in place with the per-stage
+                       counters found in STAT_KEYS
+        index_path (kwarg): Filepath of an on-disk index to read and update
+        algorithm (kwarg): Name of the hash algorithm found in ALGORITHMS
+        chunk_size (kwarg): Number of bytes to read at a time when hashing
+        executor (kwarg): One of executors.MODES to hash files with, or an
+                          executors.Executor to run the scan on, in which
+                          case workers and queue_depth are its own
+        workers (kwarg): Number of worker processes or threads
+        queue_depth (kwarg): Largest number of files in flight at once
+        preview_size (kwarg): Tuple of the largest (width, height) a preview
+                              is shown at. If given, the workers decode the
+                              images at a reduced scale and only send back
+                              a preview of that size, see make_preview.
+                              This decodes every image, so the front-ends
+                              leave it out and only make previews of the
+                              frames they show
+        ring_slots (kwarg): Number of slots in the SharedRing that worker
+                            processes send ImageData contents through. If
+                            0, or the workers are threads, the contents are
+                            pickled instead
+        payload_only (kwarg): If True, JPEGs and PNGs are matched on their
+                              image data alone, ignoring EXIF, XMP, text
+                              chunks and other metadata
+        memory_limit (kwarg): Most bytes of file data to hold at once across
+                              the parent and the workers. Unbounded if None
+        tree_min_bytes (kwarg): Size from which files are tree hashed across
+                                the workers. Never if None, or payload_only.
+                                Tree digests differ from plain ones but are
+                                only compared between files of one size
+        hash_all (kwarg): If True, every file is hashed in full, including
+                          those found unique by size or partial hash
+        scan_kwargs (kwargs): Passed on to scan, e.g. exclude or max_depth
     """
     if img_types is None:
         img_types = {'.jpg', '.jpeg', '.tiff', '.gif', '.png'}
-    con, cur = setup_db()
-    crawler = crawl(cwd, img_types)
-    pool_args = (generate_hash, crawler, 10)
-    with Pool() as pool:
-        for fpath, hash_result, mem in pool.imap_unordered(*pool_args):
-            if isinstance(hash_result, Exception):
-                yield False, fpath, zlib.compress(b'')  # Log
+    if algorithm not in ALGORITHMS:
+        choices = ', '.join(ALGORITHMS)
+        raise ValueError(f'algorithm must be one of {choices}')
+    if stats is None:
+        stats = {}
+    stats.update(dict.fromkeys(STAT_KEYS, 0))
+    con, cur = setup_db(index_path)
+    seen = SeenHashes()
+    index_writer = BatchWriter(con, index.UPDATE_SQL)
+    try:
+        sizes, keys = {}, {}
+        by_size = defaultdict(list)
+        for fpath, st in scan(cwd, img_types, **scan_kwargs):
+            if st is None:
+                mem = ImageData(fpath, b'') if previews else None
+                yield Result(
+                    False, fpath, None, None, mem, 'Could not stat file'
+                )
+                continue
+            sizes[fpath] = st.st_size
+            if index_path is not None:
+                keys[fpath] = index.index_key(fpath, st)
+            by_size[st.st_size].append(fpath)
+            stats['files'] += 1
+            stats['bytes'] += st.st_size
+        if index_path is not None:
+            index.mark_seen(cur, keys.values())
+        uniques, partial_candidates, full_candidates = [], [], []
+        cached = {}
+        index_algorithm = f'{algorithm}+payload' if payload_only else algorithm
+        if payload_only:
+            tree_min_bytes = None
+
+        def is_tree(size):
+            return tree_min_bytes is not None and (
+                size >= max(tree_min_bytes, 1)
+            )
+
+        def stored_as(size):
+            return f'{algorithm}+tree' if is_tree(size) else index_algorithm
+
+        for size, fpaths in by_size.items():
+            if len(fpaths) == 1 and not (payload_only or hash_all):
+                uniques.extend(fpaths)
+                stats['size_unique_files'] += 1
+                stats['size_skipped_bytes'] += size
+                continue
+            if index_path is not None:
+                for fpath in fpaths:
+                    f_hash = index.lookup(cur, keys[fpath], stored_as(size))
+                    if f_hash is not None:
+                        cached[fpath] = f_hash
+                        stats['index_hits'] += 1
+                        stats['index_skipped_bytes'] += size
+            if (
+                payload_only
+                or hash_all
+                or size <= PARTIAL_BLOCK_SIZE * 2
+                or any(f in cached for f in fpaths)
+            ):
+                # The partial hash would read the whole file anyway or the
+                # full hash is already known for some of the files
+                full_candidates.extend(f for f in fpaths if f not in cached)
             else:
-                cur.execute(
-                    'SELECT * FROM file_hashes WHERE hash = (?);',
-                    (hash_result,)
+                partial_candidates.extend(fpaths)
+        del by_size
+        if isinstance(executor, Executor):
+            executor.resolve(
+                full_candidates or partial_candidates, ALGORITHMS[algorithm]
+            )
+        else:
+            executor = Executor(
+                executor,
+                workers=workers,
+                queue_depth=queue_depth,
+                sample=full_candidates or partial_candidates,
+                hash_factory=ALGORITHMS[algorithm]
+            )
+        stats['executor'], stats['workers'] = executor.mode, executor.workers
+        budget = MemoryBudget()
+        if memory_limit is not None:
+            # The read buffers and the SharedRing are held for the whole scan
+            chunk_size = min(
+                chunk_size,
+                max(memory_limit // (4 * executor.workers), MIN_CHUNK_SIZE)
+            )
+            ring_slots = min(ring_slots, memory_limit // 4 // INLINE_MAX_BYTES)
+            budget = MemoryBudget(
+                max(
+                    memory_limit
+                    - executor.workers * chunk_size
+                    - ring_slots * INLINE_MAX_BYTES,
+                    chunk_size
                 )
-                exists = True if cur.fetchone() else False
-                if not exists:
-                    cur.execute(
-                        'INSERT INTO file_hashes (hash) VALUES (?);',
-                        (hash_result,)
+            )
+
+        def cancelled():
+            return stopped.is_set()
+
+        def cost(fpath):
+            size = sizes[fpath]
+            if not previews:
+                return chunk_size
+            nbytes = 2 * size if size <= INLINE_MAX_BYTES else chunk_size
+            if preview_size is not None:
+                nbytes += size * PREVIEW_DECODE_FACTOR
+            return nbytes
+
+        def partial_cost(fpath):
+            return PARTIAL_BLOCK_SIZE * 2
+
+        def batch_cost(batch):
+            return sum(map(cost, batch))
+
+        ring = None
+        if previews and ring_slots and executor.mode != 'threads':
+            ring = transport.SharedRing(ring_slots, INLINE_MAX_BYTES)
+        start = time.perf_counter()
+        with executor:
+            stopped = executor.stopped
+            if memory_limit is not None:
+                executor.chunksize = 1
+            for fpath, mem in read_previews(
+                executor,
+                budget.admit(uniques, cost, cancelled),
+                previews,
+                preview_size,
+                ring
+            ):
+                budget.release(fpath)
+                yield Result(False, fpath, sizes[fpath], None, mem)
+            uniques = []
+            partials = defaultdict(list)
+            for fpath, hash_result in executor.map_io(
+                partial(generate_partial_hash, algorithm=algorithm),
+                budget.admit(partial_candidates, partial_cost, cancelled)
+            ):
+                budget.release(fpath)
+                if isinstance(hash_result, Exception):
+                    mem = ImageData(fpath, b'') if previews else None
+                    yield Result(
+                        False, fpath, sizes[fpath], None, mem, str(hash_result)
+                    )
+                else:
+                    stats['partial_hashed_bytes'] += PARTIAL_BLOCK_SIZE * 2
+                    partials[(sizes[fpath], hash_result)].append(fpath)
+            for (size, _), fpaths in partials.items():
+                if len(fpaths) == 1:
+                    uniques.extend(fpaths)
+                    stats['partial_unique_files'] += 1
+                    stats['partial_skipped_bytes'] += (
+                        size - PARTIAL_BLOCK_SIZE * 2
+                    )
+                else:
+                    full_candidates.extend(fpaths)
+            del partials
+            trees = [f for f in full_candidates if is_tree(sizes[f])]
+            if trees:
+                full_candidates = [
+                    f for f in full_candidates if not is_tree(sizes[f])
+                ]
+            for fpath, hash_result in hash_trees(
+                executor, trees, sizes, algorithm, chunk_size, budget
+            ):
+                if isinstance(hash_result, Exception):
+                    mem = ImageData(fpath, b'') if previews else None
+                    yield Result(
+                        False, fpath, sizes[fpath], None, mem, str(hash_result)
                     )
-                    con.commit()
-                yield exists, fpath, mem
-    con.close()
+                    continue
+                stats['full_hashed_bytes'] += sizes[fpath]
+                stats['tree_hashed_files'] += 1
+                if index_path is not None:
+                    index_writer.add(
+                        (*keys[fpath], stored_as(sizes[fpath]), hash_result)
+                    )
+                cached[fpath] = hash_result
+            del trees
+            for fpath, mem in read_previews(
+                executor,
+                budget.admit(uniques, cost, cancelled),
+                previews,
+                preview_size,
+                ring
+            ):
+                budget.release(fpath)
+                yield Result(False, fpath, sizes[fpath], None, mem)
+            for fpath, mem in read_previews(
+                executor,
+                budget.admit(cached, cost, cancelled),
+                previews,
+                preview_size,
+                ring
+            ):
+                budget.release(fpath)
+                f_hash = cached[fpath]
+                if mem is not None:
+                    mem.digest = f_hash
+                match = seen.check(f_hash, fpath)
+                yield Result(match, fpath, sizes[fpath], f_hash, mem)
+            hasher = partial(
+                generate_hash,
+                previews=previews,
+                algorithm=algorithm,
+                chunk_size=chunk_size,
+                preview_size=preview_size,
+                payload_only=payload_only
+            )
+            schedule = Schedule(
+                full_candidates,
+                sizes.__getitem__,
+                executor.workers,
+                min(BATCH_FILES, executor.queue_depth // executor.workers)
+            )
+            for fpath, hash_result, mem in map_shared(
+                executor.map_hash,
+                hasher,
+                budget.admit(schedule, batch_cost, cancelled),
+                ring,
+                batched=True
+            ):
+                if (batch := schedule.done(fpath)) is not None:
+                    budget.release(batch)
+                if isinstance(hash_result, Exception):
+                    yield Result(
+                        False, fpath, sizes[fpath], None, mem, str(hash_result)
+                    )
+                else:
+                    stats['full_hashed_bytes'] += sizes[fpath]
+                    if index_path is not None:
+                        index_writer.add(
+                            (
+                                *keys[fpath],
+                                stored_as(sizes[fpath]),
+                                hash_result
+                            )
+                        )
+                    match = seen.check(hash_result, fpath)
+                    yield Result(match, fpath, sizes[fpath], hash_result, mem)
+        stats['pool_seconds'] = elapsed = time.perf_counter() - start
+        if elapsed:
+            hashed = stats['partial_hashed_bytes'] + stats['full_hashed_bytes']
+            stats['bytes_per_second'] = hashed / elapsed
+        stats['tail_seconds'] = executor.tail_seconds
+        stats['worker_utilisation'] = executor.utilisation
+        stats['peak_budget_bytes'] = budget.peak
+        stats['peak_rss_bytes'], stats['peak_worker_rss_bytes'] = peak_rss()
+        if (recorder := metrics.recorder()) is not None:
+            recorder.gauge('peak_rss_bytes', stats['peak_rss_bytes'] or 0)
+        index_writer.flush()
+        # A crawl narrowed by exclude or max_depth didn't look for the
+        # files it skipped, so their entries are kept
+        narrowed = (
+            scan_kwargs.get('exclude')
+            or scan_kwargs.get('max_depth') is not None
+        )
+        if index_path is not None and not narrowed:
+            stats['index_pruned'] = index.prune(cur, cwd)
+    finally:
+        # Also when the iterator is closed early, so no hashes are lost
+        index_writer.flush()
+        con.commit()
+        con.close()
+
+
+def read_previews(
+    executor, fpaths, previews, preview_size=None, ring=None
+):
+    """Iterator that yields a tuple of (filepath, mem) for files that do not
+    need to be hashed
+
+    Required:
+        executor (arg): The executors.Executor to read the files with
+        fpaths (arg): Iterable of filepaths
+        previews (arg): If False, the files are not read and mem is None
 
+    Optional:
+        preview_size (arg/kwarg): If given, the files are decoded into
+                                  previews of this size on the hashing pool
+        ring (arg/kwarg): A transport.SharedRing for processes to send the
+                          contents through
+    """
+    if not previews:
+        for fpath in fpaths:
+            yield fpath, None
+        return
+    if preview_size is None:
+        if executor.mode != 'processes':
+            ring = None  # Read on threads, there's nothing to pickle
+        yield from map_shared(executor.map_io, load_image, fpaths, ring)
+    else:
+        yield from map_shared(
+            executor.map_hash,
+            partial(load_image, preview_size=preview_size),
+            fpaths,
+            ring
+        )
+
+
+def map_shared(mapper, func, fpaths, ring, batched=False):
+    """Iterator over mapper(func, fpaths) that, given a SharedRing, has the
+    workers send ImageData contents through it. Slots left unused are given
+    back straight away, the rest once the ImageData is read or released.
+
+    Required:
+        mapper (arg): An Executor's map_io or map_hash
+        func (arg): A worker function returning a tuple holding an ImageData
+        fpaths (arg): Iterable of filepaths
+        ring (arg): A transport.SharedRing or None
+
+    Optional:
+        batched (arg/kwarg): If True, fpaths is an iterable of tuples of
+                             filepaths, like a Schedule
+    """
+    if ring is None:
+        yield from mapper(func, fpaths, batched)
+        return
+    recorder = metrics.recorder()
+    if batched:
+        tasks = (
+            tuple(SharedTask(fpath, ring.acquire()) for fpath in batch)
+            for batch in fpaths
+        )
+    else:
+        tasks = (SharedTask(fpath, ring.acquire()) for fpath in fpaths)
+    for slot, result in mapper(
+        Shared(func, ring.name, ring.slot_size), tasks, batched
+    ):
+        for mem in result:
+            if isinstance(mem, ImageData):
+                break
+        else:
+            mem = None
+        if mem is not None and mem.shared is not None:
+            mem.ring = ring
+            if recorder is not None:
+                recorder.inc('shared_bytes', mem.shared[1])
+        elif slot is not None:
+            ring.release(slot)
+        yield result
+
+
+def hash_trees(executor, fpaths, sizes, algorithm, chunk_size, budget):
+    """Iterator that yields a tuple of (filepath, tree hash or Exception)
+    for each file, once all its leaves are hashed. The leaves of every file
+    are spread across the executor's workers, largest files first.
 
-def crawl(cwd, img_types):
+    Required:
+        executor (arg): The executors.Executor to hash the leaves with
+        fpaths (arg): Iterable of filepaths
+        sizes (arg): dict of filepath to size in bytes
+        algorithm (arg): Name of the hash algorithm found in ALGORITHMS
+        chunk_size (arg): Number of bytes to read at a time
+        budget (arg): The executors.MemoryBudget to admit leaves through
+    """
+    leaves = {}  # Leaf digests by offset, by filepath
+    for fpath in fpaths:
+        leaves[fpath] = {}
+    if not leaves:
+        return
+    stopped = executor.stopped
+    schedule = Schedule(
+        (
+            Leaf(fpath, offset, min(TREE_LEAF_BYTES, sizes[fpath] - offset))
+            for fpath in leaves
+            for offset in range(0, sizes[fpath], TREE_LEAF_BYTES)
+        ),
+        attrgetter('length'),
+        executor.workers,
+        min(BATCH_FILES, executor.queue_depth // executor.workers)
+    )
+    hasher = partial(
+        generate_leaf_hash, algorithm=algorithm, chunk_size=chunk_size
+    )
+    for leaf, hash_result in executor.map_io(
+        hasher,
+        budget.admit(
+            schedule,
+            lambda batch: chunk_size * len(batch),
+            stopped.is_set
+        ),
+        batched=True
+    ):
+        if (batch := schedule.done(leaf)) is not None:
+            budget.release(batch)
+        if (digests := leaves.get(leaf.fpath)) is None:
+            continue  # An earlier leaf failed
+        if isinstance(hash_result, Exception):
+            del leaves[leaf.fpath]
+            yield leaf.fpath, hash_result
+            continue
+        digests[leaf.offset] = hash_result
+        size = sizes[leaf.fpath]
+        if len(digests) * TREE_LEAF_BYTES >= size:
+            del leaves[leaf.fpath]
+            yield leaf.fpath, tree_digest(
+                algorithm, size, (digests[k] for k in sorted(digests))
+            )
+
+
+def crawl(cwd, img_types, **scan_kwargs):
     """Iterator that yields the filepath of a file that is found
     in img_types
 
     Required:
         img_types (arg): Array object containting exention types to use
+
+    Optional:
+        scan_kwargs (kwargs): Passed on to scan
     """
-    for root, dirs, files in os.walk(cwd):
-        for f in files:
-            if os.path.splitext(f)[1].lower() in img_types:
-                yield os.path.join(root, f)
+    for fpath, _ in scan(cwd, img_types, **scan_kwargs):
+        yield fpath
 
 
-def generate_hash(fpath):
-    """Returns a tuple of the filepath and an MD5 hash for the specified file
-    or an Exception
+def scan(
+    cwd,
+    img_types,
+    workers=None,
+    exclude=None,
+    max_depth=None,
+    follow_symlinks=False
+):
+    """Iterator that yields a tuple of (filepath, os.stat_result) for each file
+    found in img_types as soon as it is found. Directories are listed
+    concurrently with os.scandir on a thread pool. The os.stat_result comes
+    from the DirEntry and is None if the file could not be stat'd.
+
+    Required:
+        img_types (arg): Array object containting exention types to use
+
+    Optional:
+        workers (kwarg): Number of directory listing threads
+        exclude (kwarg): Array object of glob patterns. Files and directories
+                         whose name or path match any pattern are skipped
+        max_depth (kwarg): Deepest level of subdirectories to descend into,
+                           0 being cwd only. Unlimited if None
+        follow_symlinks (kwarg): If True, symlinked directories are descended
+                                 into. Directories are only visited once so
+                                 symlink loops are skipped
+    """
+    exclude = tuple(exclude or ())
+    recorder = metrics.recorder()
+    results = ImageQueue()
+    stopped = Event()
+    lock = Lock()
+    pending = 0
+    visited = set()
+
+    def excluded(entry):
+        return any(
+            fnmatch(entry.name, pattern) or fnmatch(entry.path, pattern)
+            for pattern in exclude
+        )
+
+    def submit(path, depth):
+        nonlocal pending
+        if follow_symlinks:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return
+            with lock:
+                if (st.st_dev, st.st_ino) in visited:
+                    return
+                visited.add((st.st_dev, st.st_ino))
+        with lock:
+            pending += 1
+        executor.submit(list_dir, path, depth)
+
+    def list_dir(path, depth):
+        nonlocal pending
+        if recorder is not None:
+            recorder.inc('crawl_dirs')
+            start = time.perf_counter()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if stopped.is_set():
+                        break
+                    if exclude and excluded(entry):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_symlinks):
+                            if max_depth is None or depth < max_depth:
+                                submit(entry.path, depth + 1)
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() in img_types:
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            st = None  # Log
+                        results.put((entry.path, st))
+                        if recorder is not None and st is not None:
+                            recorder.inc('crawl_files')
+                            recorder.inc('crawl_bytes', st.st_size)
+        except OSError:
+            pass  # Log
+        finally:
+            if recorder is not None:
+                recorder.observe('crawl_dir', time.perf_counter() - start)
+            with lock:
+                pending -= 1
+                if not pending:
+                    results.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            submit(cwd, 0)
+            with lock:
+                if not pending:
+                    results.close()
+            yield from results
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def generate_hash(
+    fpath,
+    previews=True,
+    algorithm='md5',
+    chunk_size=None,
+    preview_size=None,
+    payload_only=False
+):
+    """Returns a tuple of the filepath, a hash for the specified file
+    or an Exception, and an ImageData object for the file
+
+    Files small enough to be sent inline are read in a single call. Larger
+    files are read with readinto into a buffer that is reused between calls
+    and hashed through a memoryview, so no per-chunk bytes are created.
 
     Required:
         fpath (arg): A filepath or a PathLike object
+
+    Optional:
+        previews (kwarg): If False, None is returned in place of the ImageData
+        algorithm (kwarg): Name of the hash algorithm found in ALGORITHMS
+        chunk_size (kwarg): Number of bytes to read at a time. Defaults to
+                            CHUNK_SIZE
+        preview_size (kwarg): If given, the ImageData holds a preview of this
+                              size in place of the file's contents
+        payload_only (kwarg): If True, only the image data of JPEGs and PNGs
+                              is hashed, see payload.hash_payload
     """
     try:
-        mem_bytes = b''
-        f_hash = hashlib.md5()
+        f_hash = ALGORITHMS[algorithm]()
+        mem = ImageData(fpath) if previews else None
+        with open(fpath, 'rb', buffering=0) as f:
+            if previews and os.fstat(f.fileno()).st_size <= INLINE_MAX_BYTES:
+                mem.data = f.readall()
+                if payload_only:
+                    f_hash = payload.hash_payload(
+                        BytesIO(mem.data),
+                        f_hash,
+                        get_buffer(chunk_size or CHUNK_SIZE)
+                    )
+                else:
+                    f_hash.update(mem.data)
+            elif payload_only:
+                f_hash = payload.hash_payload(
+                    f, f_hash, get_buffer(chunk_size or CHUNK_SIZE)
+                )
+            elif (recorder := metrics.recorder()) is not None:
+                view = get_buffer(chunk_size or CHUNK_SIZE)
+                hash_file(f, f_hash, view, recorder)
+            else:
+                view = get_buffer(chunk_size or CHUNK_SIZE)
+                while size := f.readinto(view):
+                    f_hash.update(view[:size])
+    except Exception as e:
+        return fpath, e, ImageData(fpath, b'') if previews else None
+    else:
+        digest = f_hash.digest()
+        if mem is not None:
+            mem.digest = digest
+            if preview_size is not None:
+                shrink(mem, preview_size)
+        return fpath, digest, mem
+
+
+def hash_file(f, f_hash, view, recorder):
+    """Reads the rest of f into view and updates f_hash with it, recording
+    the time spent reading and hashing separately in recorder
+    """
+    read_seconds, hash_seconds, total = 0.0, 0.0, 0
+    while True:
+        start = time.perf_counter()
+        size = f.readinto(view)
+        read = time.perf_counter()
+        read_seconds += read - start
+        if not size:
+            break
+        f_hash.update(view[:size])
+        hash_seconds += time.perf_counter() - read
+        total += size
+    recorder.observe('hash_read', read_seconds)
+    recorder.observe('hash_digest', hash_seconds)
+    recorder.inc('hash_bytes', total)
+    recorder.inc('hash_files')
+
+
+def generate_leaf_hash(leaf, algorithm='md5', chunk_size=None):
+    """Returns a tuple of the Leaf and a hash of its byte range or an
+    Exception
+
+    Required:
+        leaf (arg): A Leaf of (filepath, offset, length)
+
+    Optional:
+        algorithm (kwarg): Name of the hash algorithm found in ALGORITHMS
+        chunk_size (kwarg): Number of bytes to read at a time. Defaults to
+                            CHUNK_SIZE
+    """
+    try:
+        f_hash = ALGORITHMS[algorithm]()
+        view = get_buffer(chunk_size or CHUNK_SIZE)
+        remaining = leaf.length
+        with open(leaf.fpath, 'rb', buffering=0) as f:
+            f.seek(leaf.offset)
+            while remaining:
+                size = f.readinto(view[:min(remaining, len(view))])
+                if not size:
+                    raise ValueError('File shrank while being hashed')
+                f_hash.update(view[:size])
+                remaining -= size
+    except Exception as e:
+        return leaf, e
+    else:
+        return leaf, f_hash.digest()
+
+
+def tree_digest(algorithm, size, leaf_digests):
+    """Returns the root hash of a file hashed as consecutive leaves of
+    TREE_LEAF_BYTES, which is the hash of the file's size followed by the
+    leaf digests in order. Leaves can be hashed on different workers, so a
+    single huge file is not left to one of them.
+
+    Required:
+        algorithm (arg): Name of the hash algorithm found in ALGORITHMS
+        size (arg): The file's size in bytes
+        leaf_digests (arg): Iterable of the leaves' digests, in file order
+    """
+    f_hash = ALGORITHMS[algorithm]()
+    f_hash.update(b'tree:%d:%d:' % (TREE_LEAF_BYTES, size))
+    for digest in leaf_digests:
+        f_hash.update(digest)
+    return f_hash.digest()
+
+
+def generate_partial_hash(fpath, algorithm='md5'):
+    """Returns a tuple of the filepath and a hash of the first and last
+    PARTIAL_BLOCK_SIZE bytes of the specified file or an Exception
+
+    Required:
+        fpath (arg): A filepath or a PathLike object
+
+    Optional:
+        algorithm (kwarg): Name of the hash algorithm found in ALGORITHMS
+    """
+    try:
+        f_hash = ALGORITHMS[algorithm]()
         with open(fpath, 'rb') as f:
-            while chunk := f.read(8192):
-                f_hash.update(chunk)
-                mem_bytes += chunk
+            f_hash.update(f.read(PARTIAL_BLOCK_SIZE))
+            f.seek(-PARTIAL_BLOCK_SIZE, os.SEEK_END)
+            f_hash.update(f.read(PARTIAL_BLOCK_SIZE))
     except Exception as e:
-        return fpath, e, b''
+        return fpath, e
     else:
-        return fpath, f_hash.digest(), zlib.compress(mem_bytes, level=9)
+        return fpath, f_hash.digest()
+
+
+def get_buffer(chunk_size):
+    """Returns a memoryview of a bytearray of chunk_size bytes that is
+    reused by every call from the same thread
+    """
+    view = getattr(buffers, 'view', None)
+    if view is None or len(view) != chunk_size:
+        view = buffers.view = memoryview(bytearray(chunk_size))
+    return view
+
+
+def load_image(fpath, preview_size=None):
+    """Returns a tuple of the filepath and an ImageData object for the file
+
+    Required:
+        fpath (arg): A filepath or a PathLike object
 
+    Optional:
+        preview_size (kwarg): If given, the ImageData holds a preview of this
+                              size in place of the file's contents
+    """
+    try:
+        with open(fpath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > INLINE_MAX_BYTES:
+                mem = ImageData(fpath)
+            else:
+                mem = ImageData(fpath, f.read())
+    except Exception:
+        return fpath, ImageData(fpath, b'')  # Log
+    if preview_size is not None:
+        shrink(mem, preview_size)
+    return fpath, mem
+
+
+def shrink(mem, preview_size):
+    """Replaces the contents of mem with a preview made by make_preview. mem
+    is left as is if the image can't be decoded.
+
+    Required:
+        mem (arg): An ImageData object
+        preview_size (arg): Tuple of the largest (width, height)
+    """
+    source = mem.fpath if mem.data is None else mem.data
+    try:
+        if (recorder := metrics.recorder()) is not None:
+            with recorder.timer('preview'):
+                mem.data = make_preview(source, preview_size)
+        else:
+            mem.data = make_preview(source, preview_size)
+    except Exception:
+        pass  # Log
+
+
+def make_preview(source, preview_size):
+    """Returns the image downscaled to fit preview_size, encoded as a JPEG or
+    as a PNG if it has transparency or a palette.
 
-def setup_db():
-    """Creates an in-memory SQLite DB.
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale with draft, so the full
+    resolution pixels are never made, and other images are shrunk by an
+    integer factor with reduce before the final resize.
+
+    Required:
+        source (arg): A filepath or the encoded image as bytes
+        preview_size (arg): Tuple of the largest (width, height)
+    """
+    from PIL import Image
+
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    with Image.open(source) as img:
+        img.draft(None, preview_size)
+        width, height = preview_size
+        factor = min(img.width // max(width, 1), img.height // max(height, 1))
+        if factor > 1 and img.mode in ('L', 'RGB', 'RGBA'):
+            img = img.reduce(factor)
+        img.thumbnail(preview_size)
+        if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+        output = BytesIO()
+        if img.mode in ('L', 'RGB'):
+            img.save(output, 'JPEG', quality=PREVIEW_QUALITY)
+        else:
+            img.save(output, 'PNG')
+    return output.getvalue()
+
+
+def peak_rss():
+    """Returns a tuple of the peak resident set size in bytes of this process
+    and of its largest finished child process, else (None, None) if the
+    platform doesn't report it
+    """
+    if resource is None:
+        return None, None
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in KiB
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    )
+
+
+def setup_db(index_path=None):
+    """Creates an SQLite DB, in memory unless index_path is given, in which
+    case the on-disk index at that location is opened (and created if
+    needed).
+
+    Optional:
+        index_path (arg/kwarg): Filepath of an on-disk index
 
     returns a tuple of (connection (con), cursor (cur))
     """
-    con = sqlite3.connect(':memory:')
-    cur = con.cursor()
-    cur.execute('CREATE TABLE file_hashes(hash TEXT NOT NULL);')
-    cur.execute('CREATE UNIQUE INDEX hash_index ON file_hashes(hash);')
-    con.commit()
+    if index_path is None:
+        con = sqlite3.connect(':memory:')
+        cur = con.cursor()
+    else:
+        con = sqlite3.connect(index_path)
+        cur = con.cursor()
+        index.setup_index(cur)
+        con.commit()
     return con, cur
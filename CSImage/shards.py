@@ -0,0 +1,401 @@
+import heapq
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+from search import BatchWriter, find
+
+
+SHARDS = 16
+SHARD_NAME = 'shard-{:03d}.db'
+INSERT_SQL = 'INSERT INTO entries (digest, size, path) VALUES (?, ?, ?);'
+
+
+class ShardSet:
+    """Writes the digests found by a scan of one root to shards, SQLite DBs
+    that each hold the digests starting with one range of prefixes. Shard
+    n of shards holds the digests whose first two bytes, as a big-endian
+    number, are in [n * 65536 // shards, (n + 1) * 65536 // shards), so
+    reading the shards in order reads the digests in order.
+
+    Every shard keeps a meta table of the root, host, algorithm and shard
+    count it was written with, see merge.
+
+    Required:
+        path (arg): Directory to write the shards into, created if missing
+        meta (arg): dict of the meta values, see scan
+
+    Optional:
+        shards (arg/kwarg): Number of shards, at most 65536
+    """
+
+    def __init__(self, path, meta, shards=SHARDS):
+        if not 1 <= shards <= 65536:
+            raise ValueError('shards must be between 1 and 65536')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shards = shards
+        self.cons = []
+        self.writers = []
+        for partition in range(shards):
+            fpath = os.path.join(path, SHARD_NAME.format(partition))
+            if os.path.exists(fpath):
+                os.remove(fpath)
+            con = sqlite3.connect(fpath)
+            con.execute('PRAGMA journal_mode=OFF;')
+            con.execute('PRAGMA synchronous=OFF;')
+            con.execute(
+                '''CREATE TABLE entries(
+                    digest BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    path TEXT NOT NULL
+                );'''
+            )
+            con.execute(
+                'CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT);'
+            )
+            con.executemany(
+                'INSERT INTO meta (key, value) VALUES (?, ?);',
+                [
+                    (key, json.dumps(value)) for key, value in {
+                        **meta, 'shards': shards, 'partition': partition
+                    }.items()
+                ]
+            )
+            con.commit()
+            self.cons.append(con)
+            self.writers.append(BatchWriter(con, INSERT_SQL))
+
+    def add(self, digest, size, fpath):
+        partition = int.from_bytes(digest[:2], 'big') * self.shards >> 16
+        self.writers[partition].add(
+            (digest, size, os.path.abspath(fpath))
+        )
+
+    def close(self):
+        """Flushes the pending rows and indexes every shard by digest, which
+        is what merge reads them in the order of
+        """
+        for con, writer in zip(self.cons, self.writers):
+            writer.flush()
+            con.execute('CREATE INDEX digest_index ON entries(digest, path);')
+            con.commit()
+            con.close()
+        self.cons, self.writers = [], []
+
+
+def scan(
+    roots,
+    output,
+    shards=SHARDS,
+    jobs=None,
+    split=False,
+    algorithm='md5',
+    payload_only=False,
+    tree_min_bytes=None,
+    **find_kwargs
+):
+    """Scans every root in roots, jobs of them at a time, each into its own
+    ShardSet in a subdirectory of output named after the host, the root's
+    position in roots and its name. Every file is hashed in full so the
+    shards can be merged with those of other roots, runs and machines.
+
+    With split, each root is scanned as the separate roots from split_roots,
+    which shards a single directory tree for a run on one machine.
+
+    returns a dict of the counts of files, hashed files and errors by root
+
+    Required:
+        roots (arg): Array object of directories to scan
+        output (arg): Directory to write the shard sets into
+
+    Optional:
+        shards (arg/kwarg): Number of shards per root
+        jobs (kwarg): Number of roots scanned at once. Defaults to one per
+                      CPU, or per root if there are fewer roots
+        split (kwarg): If True, roots are split up with split_roots
+        algorithm (kwarg): Name of the hash algorithm found in ALGORITHMS
+        payload_only (kwarg): Passed on to find
+        tree_min_bytes (kwarg): Passed on to find. Shards written with
+                                different sizes can't be merged
+        find_kwargs (kwargs): Passed on to find. workers defaults to the
+                              CPUs split between the jobs. An index_path
+                              can't be shared by roots scanned at once
+    """
+    if split:
+        roots = [
+            (root, {'max_depth': 0} if root == cwd else {})
+            for cwd in roots
+            for root in split_roots(cwd)
+        ]
+    else:
+        roots = [(root, {}) for root in roots]
+    if jobs is None:
+        jobs = min(len(roots), os.cpu_count() or 1) or 1
+    if find_kwargs.get('workers') is None:
+        find_kwargs['workers'] = max((os.cpu_count() or 1) // jobs, 1)
+    host = socket.gethostname()
+    meta = {
+        'host': host,
+        'algorithm': f'{algorithm}+payload' if payload_only else algorithm,
+        'tree_min_bytes': tree_min_bytes,
+        'created': time.time(),
+    }
+
+    def scan_root(idx, job):
+        root, root_kwargs = job
+        name = os.path.basename(os.path.abspath(root)) or 'root'
+        shard_set = ShardSet(
+            os.path.join(output, f'{host}-{idx:03d}-{name}'),
+            {**meta, 'root': os.path.abspath(root)},
+            shards
+        )
+        counts = {'files': 0, 'hashed': 0, 'errors': 0}
+        try:
+            for result in find(
+                root,
+                previews=False,
+                algorithm=algorithm,
+                payload_only=payload_only,
+                tree_min_bytes=tree_min_bytes,
+                hash_all=True,
+                **{**find_kwargs, **root_kwargs}
+            ):
+                counts['files'] += 1
+                if result.digest is None:
+                    counts['errors'] += 1
+                else:
+                    counts['hashed'] += 1
+                    shard_set.add(result.digest, result.size, result.fpath)
+        finally:
+            shard_set.close()
+        return root, counts
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(executor.map(scan_root, range(len(roots)), roots))
+
+
+def split_roots(cwd):
+    """Returns a list of the subdirectories of cwd, and cwd itself if it
+    holds any files, to scan as separate roots. cwd itself is scanned with
+    max_depth=0 so its subdirectories aren't scanned twice.
+    """
+    roots = []
+    has_files = False
+    with os.scandir(cwd) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.is_dir(follow_symlinks=False):
+                roots.append(entry.path)
+            elif entry.is_file():
+                has_files = True
+    if has_files:
+        roots.insert(0, cwd)
+    return roots
+
+
+def find_sets(paths):
+    """Returns a sorted list of the shard set directories in paths, which
+    are either shard sets or directories holding them, such as the output
+    of scan
+    """
+    shard_sets = set()
+    for path in paths:
+        if os.path.exists(os.path.join(path, SHARD_NAME.format(0))):
+            shard_sets.add(path)
+            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir() and os.path.exists(
+                    os.path.join(entry.path, SHARD_NAME.format(0))
+                ):
+                    shard_sets.add(entry.path)
+    return sorted(shard_sets)
+
+
+def read_meta(shard_set):
+    con = sqlite3.connect(
+        f'file:{os.path.join(shard_set, SHARD_NAME.format(0))}?mode=ro',
+        uri=True
+    )
+    try:
+        return {
+            key: json.loads(value)
+            for key, value in con.execute('SELECT key, value FROM meta;')
+        }
+    finally:
+        con.close()
+
+
+def read_set(shard_set, meta):
+    """Iterator that yields a tuple of (digest, size, host, path) for every
+    entry in shard_set, in order of digest then path
+    """
+    host = meta['host']
+    for partition in range(meta['shards']):
+        fpath = os.path.join(shard_set, SHARD_NAME.format(partition))
+        con = sqlite3.connect(f'file:{fpath}?mode=ro', uri=True)
+        try:
+            for digest, size, path in con.execute(
+                '''SELECT digest, size, path FROM entries
+                    ORDER BY digest, path;'''
+            ):
+                yield digest, size, host, path
+        finally:
+            con.close()
+
+
+def merge(paths, output=None):
+    """Merges the shard sets found in paths, see find_sets, into one report
+    of duplicates written as JSON Lines to output, one group per line in
+    order of digest:
+
+        {"digest": hex, "size": bytes, "copies": [{"host": h, "path": p}]}
+
+    The shard sets are read in digest order and merged with heapq.merge, so
+    only one entry per shard set and the copies of one digest are held in
+    memory however many files there are. A path found in more than one
+    shard set, such as by two runs over the same root, is listed once.
+
+    Raises ValueError if the shard sets were written with different
+    algorithms or tree_min_bytes, whose digests can't be compared.
+
+    returns a dict of the counts in the report
+
+    Required:
+        paths (arg): Array object of shard sets or directories holding them
+
+    Optional:
+        output (arg/kwarg): Filepath for the JSON Lines. Defaults to stdout
+    """
+    shard_sets = find_sets(paths)
+    metas = [read_meta(shard_set) for shard_set in shard_sets]
+    kinds = {(meta['algorithm'], meta['tree_min_bytes']) for meta in metas}
+    if len(kinds) > 1:
+        found = ', '.join(sorted(f'{a} (tree {t})' for a, t in kinds))
+        raise ValueError(f'Shard sets were written with {found}')
+    counts = {
+        'shard_sets': len(shard_sets),
+        'files': 0,
+        'groups': 0,
+        'duplicates': 0,
+        'duplicate_bytes': 0,
+    }
+    entries = heapq.merge(
+        *(
+            read_set(shard_set, meta)
+            for shard_set, meta in zip(shard_sets, metas)
+        ),
+        key=lambda entry: entry[0]
+    )
+    out = sys.stdout if output is None else open(output, 'w')
+    try:
+        for digest, group in groupby(entries, key=lambda entry: entry[0]):
+            copies = {}
+            for _, size, host, path in group:
+                copies.setdefault((host, path), size)
+            counts['files'] += len(copies)
+            if len(copies) < 2:
+                continue
+            counts['groups'] += 1
+            counts['duplicates'] += len(copies) - 1
+            counts['duplicate_bytes'] += size * (len(copies) - 1)
+            out.write(
+                json.dumps(
+                    {
+                        'digest': digest.hex(),
+                        'size': size,
+                        'copies': [
+                            {'host': host, 'path': path}
+                            for host, path in copies
+                        ],
+                    },
+                    separators=(',', ':')
+                )
+            )
+            out.write('\n')
+    finally:
+        if output is None:
+            out.flush()
+        else:
+            out.close()
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from executors import MODES
+    from search import ALGORITHMS
+
+    parser = argparse.ArgumentParser(
+        description='Scans roots into digest-sharded indexes and merges '
+                    'shards from any number of runs and machines into one '
+                    'duplicate report'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan_parser = commands.add_parser('scan', help='Scan roots into shards')
+    scan_parser.add_argument('roots', nargs='+')
+    scan_parser.add_argument(
+        '-o', '--output', required=True, help='Directory for the shard sets'
+    )
+    scan_parser.add_argument(
+        '--split',
+        action='store_true',
+        help='Scan every subdirectory of each root as a root of its own'
+    )
+    scan_parser.add_argument('--shards', type=int, default=SHARDS)
+    scan_parser.add_argument(
+        '--jobs', type=int, help='Number of roots to scan at once'
+    )
+    scan_parser.add_argument(
+        '--algorithm', choices=list(ALGORITHMS), default='md5'
+    )
+    scan_parser.add_argument('--payload-only', action='store_true')
+    scan_parser.add_argument('--executor', choices=MODES, default='processes')
+    scan_parser.add_argument(
+        '--workers', type=int, help='Hashing workers per root'
+    )
+    merge_parser = commands.add_parser(
+        'merge', help='Merge shard sets into a duplicate report'
+    )
+    merge_parser.add_argument('paths', nargs='+')
+    merge_parser.add_argument(
+        '-o', '--output', help='Filepath for the JSON Lines. Default stdout'
+    )
+    args = parser.parse_args()
+    start = time.perf_counter()
+    if args.command == 'scan':
+        by_root = scan(
+            args.roots,
+            args.output,
+            shards=args.shards,
+            jobs=args.jobs,
+            split=args.split,
+            algorithm=args.algorithm,
+            payload_only=args.payload_only,
+            executor=args.executor,
+            workers=args.workers
+        )
+        for root, counts in by_root.items():
+            print(
+                f'{root}: {counts["files"]:,} files | '
+                f'{counts["errors"]:,} errors',
+                file=sys.stderr
+            )
+    else:
+        counts = merge(args.paths, args.output)
+        print(
+            f'Shard sets: {counts["shard_sets"]:,} | '
+            f'Files: {counts["files"]:,} | '
+            f'Duplicates: {counts["duplicates"]:,} in '
+            f'{counts["groups"]:,} groups | '
+            f'{counts["duplicate_bytes"] / 1024 / 1024:,.1f} MiB',
+            file=sys.stderr
+        )
+    print(f'{time.perf_counter() - start:,.2f}s', file=sys.stderr)
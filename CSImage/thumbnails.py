@@ -0,0 +1,185 @@
+import hashlib
+import os
+import tempfile
+
+from collections import OrderedDict
+from threading import Lock
+
+import metrics
+
+from search import ImageData, make_preview
+
+
+MAX_BYTES = 256 * 1024 * 1024
+SIZE_STEP = 128  # Requested sizes are rounded up to a multiple of this
+
+
+def default_root():
+    """Returns the thumbnail directory shared by the front-ends"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache'
+    )
+    return os.path.join(cache_home, 'csimage', 'thumbnails')
+
+
+class ThumbnailCache:
+    """On-disk cache of downscaled previews keyed by the content digest of
+    the original and the size they were made for, evicting the least
+    recently used thumbnails once they take up more than max_bytes.
+
+    Files that were not hashed during the scan have no digest and are keyed
+    by their path, inode, size and mtime instead, so a cached preview never
+    needs the original to be read. Recency is kept in the thumbnails' mtimes
+    so it survives restarts. Other processes sharing root are not seen until
+    the cache is reopened, so the budget is only kept per process.
+
+    Optional:
+        root (arg/kwarg): Directory to store the thumbnails in. Defaults to
+                          default_root()
+        max_bytes (arg/kwarg): Most bytes of thumbnails to keep
+    """
+
+    def __init__(self, root=None, max_bytes=MAX_BYTES):
+        self.root = root or default_root()
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()  # Least recently used first
+        self.total = 0
+        self.load()
+
+    def load(self):
+        entries = []
+        os.makedirs(self.root, exist_ok=True)
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith('.'):
+                    continue  # An unfinished write
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, entry.name, st.st_size))
+        for _, key, size in sorted(entries):
+            self.entries[key] = size
+            self.total += size
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Returns the thumbnail stored under key, else None"""
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                if (size := self.entries.pop(key, None)) is not None:
+                    self.total -= size
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Stores data under key, evicting old thumbnails if over budget"""
+        fpath = self.path(key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=os.path.dirname(fpath))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, fpath)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.total += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+        self.evict()
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.total <= self.max_bytes or not self.entries:
+                    return
+                key, size = self.entries.popitem(last=False)
+                self.total -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def preview(self, mem, size):
+        """Returns an ImageData of a thumbnail of mem no smaller than size,
+        from the cache if possible. mem is returned as is if it can't be
+        keyed or decoded.
+
+        Required:
+            mem (arg): An ImageData object for the image
+            size (arg): Tuple of the (width, height) the image is shown at
+        """
+        if (key := thumbnail_key(mem, size)) is None:
+            return mem
+        recorder = metrics.recorder()
+        if (data := self.get(key)) is not None:
+            if recorder is not None:
+                recorder.inc('thumbnail_hits')
+            return ImageData(mem.fpath, data, mem.digest)
+        if recorder is not None:
+            recorder.inc('thumbnail_misses')
+        try:
+            data = make_preview(mem.read(), thumbnail_box(size))
+        except Exception:
+            return mem  # Not an image PIL can decode
+        self.put(key, data)
+        return ImageData(mem.fpath, data, mem.digest)
+
+
+def thumbnail_box(size):
+    """Returns size with each side rounded up to a multiple of SIZE_STEP so
+    nearby window sizes share thumbnails
+    """
+    return tuple(
+        max(-(-int(side) // SIZE_STEP) * SIZE_STEP, SIZE_STEP)
+        for side in size
+    )
+
+
+def thumbnail_key(mem, size):
+    """Returns the hex key of the thumbnail of mem made for size, else None
+    if mem has no digest and can't be stat'ed
+
+    Required:
+        mem (arg): An ImageData object for the image
+        size (arg): Tuple of the (width, height) the image is shown at
+    """
+    key = hashlib.blake2b(digest_size=16)
+    if mem.digest is not None:
+        key.update(b'digest:' + mem.digest)
+    else:
+        try:
+            st = os.stat(mem.fpath)
+        except (OSError, TypeError):
+            return None
+        key.update(
+            'stat:{}:{}:{}:{}'.format(
+                os.path.abspath(mem.fpath),
+                st.st_ino,
+                st.st_size,
+                st.st_mtime_ns
+            ).encode('utf-8', 'surrogateescape')
+        )
+    key.update('{}x{}'.format(*thumbnail_box(size)).encode('ascii'))
+    return key.hexdigest()
+
@@ -0,0 +1,114 @@
+import os
+import weakref
+
+from collections import deque
+from multiprocessing import shared_memory
+from threading import Lock
+
+
+SLOTS = 256
+SLOT_SIZE = 256 * 1024
+
+attached = {}  # SharedMemory by name, created or opened by this process
+creators = {}  # pid of the process that created each SharedMemory
+
+
+class SharedRing:
+    """A block of shared memory split into slots of slot_size bytes that
+    pool workers write results into, so only a (slot, length) descriptor is
+    pickled back to the parent.
+
+    Slots are handed out by the parent with acquire and given back with
+    release once their contents have been read. The block is unlinked once
+    the ring is garbage collected.
+
+    Optional:
+        slots (arg/kwarg): Number of slots
+        slot_size (arg/kwarg): Largest number of bytes in a slot
+    """
+
+    def __init__(self, slots=SLOTS, slot_size=SLOT_SIZE):
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=max(slots, 1) * slot_size
+        )
+        self.name = self.shm.name
+        self.slot_size = slot_size
+        self.lock = Lock()
+        self.free = deque(range(slots))
+        attached[self.name] = self.shm
+        creators[self.name] = os.getpid()
+        weakref.finalize(self, destroy, self.shm)
+
+    def acquire(self):
+        """Returns a free slot, else None if every slot is in use"""
+        with self.lock:
+            return self.free.popleft() if self.free else None
+
+    def release(self, slot):
+        with self.lock:
+            self.free.append(slot)
+
+    def view(self, slot, length):
+        """Returns a memoryview of the first length bytes of slot"""
+        start = slot * self.slot_size
+        return self.shm.buf[start:start + length]
+
+
+def attach(name):
+    """Returns the SharedMemory called name, opening it if this process
+    didn't create it or inherit it through fork. A worker only writes into
+    the ring of the scan it is running, so blocks it opened or inherited for
+    earlier scans are closed first, keeping long-lived workers from mapping
+    one block per scan.
+    """
+    if (shm := attached.get(name)) is None:
+        for other in [
+            other for other in attached
+            if creators.get(other) != os.getpid()
+        ]:
+            detach(other)
+        try:
+            shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13 opening registers the block again, with the
+            # resource tracker the workers share with the creating process,
+            # which unregisters it once it unlinks the block
+            shm = shared_memory.SharedMemory(name)
+        attached[name] = shm
+    return shm
+
+
+def write(name, slot, slot_size, data):
+    """Copies data into slot of the SharedRing called name. Returns False if
+    data is too large for a slot.
+
+    Required:
+        name (arg): The SharedRing's name
+        slot (arg): A slot from SharedRing.acquire
+        slot_size (arg): The SharedRing's slot_size
+        data (arg): A bytes-like object
+    """
+    if len(data) > slot_size:
+        return False
+    start = slot * slot_size
+    attach(name).buf[start:start + len(data)] = data
+    return True
+
+
+def detach(name):
+    shm = attached.pop(name)
+    creators.pop(name, None)
+    try:
+        shm.close()
+    except BufferError:
+        pass  # A view is still held, the mapping goes when it does
+
+
+def destroy(shm):
+    attached.pop(shm.name, None)
+    creators.pop(shm.name, None)
+    try:
+        shm.close()
+    except BufferError:
+        pass  # A view is still held, the mapping goes when it does
+    shm.unlink()
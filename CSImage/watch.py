@@ -0,0 +1,621 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import sqlite3
+import struct
+import sys
+import time
+
+from collections import defaultdict
+from fnmatch import fnmatch
+
+import index
+import metrics
+
+from search import (
+    ALGORITHMS,
+    Match,
+    Result,
+    find,
+    generate_hash,
+    load_image,
+    scan,
+)
+
+
+POLL_INTERVAL = 1.0  # Seconds between rescans when inotify isn't available
+QUIET = 1.0  # Seconds without events before a file left open is hashed
+SETTLE = 0.05  # Seconds after a writer closes a file before it is hashed
+WAKE_INTERVAL = 0.5  # Most seconds between checks of the stop Event
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_ONLYDIR
+)
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, then len bytes of name
+
+
+class Inotify:
+    """Recursive watch of a directory tree with the Linux inotify API,
+    called through libc with ctypes. read returns (kind, path) events:
+
+        'closed' a file was closed after writing or moved in
+        'written' a file was created or written to and may still be open
+        'removed' a file or directory was deleted or moved out
+        'rescan' a directory appeared, or events were lost, so everything
+                 under path has to be listed again
+
+    New subdirectories are watched as they appear, down to max_depth. A
+    directory reached through a second path, such as a symlink loop, is
+    only watched once. Raises OSError if inotify is not available or the
+    per-user watch limit is reached.
+
+    Required:
+        root (arg): Directory to watch
+
+    Optional:
+        excluded (arg/kwarg): Function returning True for a directory path
+                              that should not be watched
+        max_depth (kwarg): Deepest level of subdirectories to watch, 0 being
+                           root only. Unlimited if None
+        follow_symlinks (kwarg): If True, symlinked directories are watched
+    """
+
+    def __init__(
+        self, root, excluded=None, max_depth=None, follow_symlinks=False
+    ):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True
+        )
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'libc has no inotify_init1')
+        self.root = root
+        self.excluded = excluded
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise last_error()
+        self.paths = {}  # Directory by watch descriptor
+        try:
+            self.add(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add(self, path):
+        """Watches path and every directory below it, returning False if
+        path is too deep or excluded
+        """
+        if self.max_depth is not None and depth(self.root, path) > (
+            self.max_depth
+        ):
+            return False
+        if path != self.root and (
+            self.excluded is not None and self.excluded(path)
+        ):
+            return False
+        for dirpath, dirnames, _ in os.walk(
+            path, followlinks=self.follow_symlinks
+        ):
+            if self.excluded is not None:
+                dirnames[:] = [
+                    name for name in dirnames
+                    if not self.excluded(os.path.join(dirpath, name))
+                ]
+            if self.max_depth is not None and depth(self.root, dirpath) >= (
+                self.max_depth
+            ):
+                dirnames[:] = []
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dirpath), WATCH_MASK
+            )
+            if wd < 0:
+                if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                    dirnames[:] = []
+                    continue  # Already gone
+                raise last_error(dirpath)
+            if self.paths.get(wd, dirpath) != dirpath:
+                # The same directory by another path, a symlink loop
+                dirnames[:] = []
+                continue
+            self.paths[wd] = dirpath
+        return True
+
+    def forget(self, path):
+        """Stops watching path and every directory below it"""
+        prefix = os.path.join(path, '')
+        for wd, dirpath in list(self.paths.items()):
+            if dirpath == path or dirpath.startswith(prefix):
+                del self.paths[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Returns a list of (kind, path) events, waiting up to timeout
+        seconds for the first of them
+        """
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append(('rescan', self.root))
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if (directory := self.paths.get(wd)) is None:
+                continue
+            path = os.path.join(directory, name)
+            is_dir = mask & IN_ISDIR or (
+                self.follow_symlinks
+                and mask & (IN_CREATE | IN_MOVED_TO)
+                and os.path.isdir(path)
+            )
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                if self.add(path):
+                    events.append(('rescan', path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if is_dir or self.follow_symlinks:
+                    self.forget(path)  # A symlink may have been watched
+                events.append(('removed', path))
+            elif is_dir:
+                continue
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                events.append(('closed', path))
+            elif mask & (IN_CREATE | IN_MODIFY):
+                events.append(('written', path))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Poller:
+    """Fallback for Inotify that lists the tree every interval seconds and
+    reports the files whose size or mtime changed since the last listing as
+    'written' and those that went missing as 'removed'
+
+    Required:
+        root (arg): Directory to watch
+        img_types (arg): Array object containting exention types to use
+
+    Optional:
+        interval (arg/kwarg): Seconds between listings
+        scan_kwargs (kwargs): Passed on to search.scan
+    """
+
+    def __init__(self, root, img_types, interval=POLL_INTERVAL, **scan_kwargs):
+        self.root = root
+        self.img_types = img_types
+        self.interval = interval
+        self.scan_kwargs = scan_kwargs
+        self.listing = self.list_files()
+        self.next_scan = time.monotonic() + interval
+
+    def list_files(self):
+        files = scan(self.root, self.img_types, **self.scan_kwargs)
+        return {
+            fpath: (st.st_size, st.st_mtime_ns)
+            for fpath, st in files
+            if st is not None
+        }
+
+    def read(self, timeout):
+        wait = min(timeout, self.next_scan - time.monotonic())
+        if wait > 0:
+            time.sleep(wait)
+        if time.monotonic() < self.next_scan:
+            return []
+        listing = self.list_files()
+        self.next_scan = time.monotonic() + self.interval
+        events = [
+            ('written', fpath) for fpath, identity in listing.items()
+            if self.listing.get(fpath) != identity
+        ]
+        events.extend(
+            ('removed', fpath) for fpath in self.listing
+            if fpath not in listing
+        )
+        self.listing = listing
+        return events
+
+    def close(self):
+        pass
+
+
+class Catalog:
+    """The files seen by watch, narrowed down the way find does it: a file
+    is only hashed once another file of its size turns up, and the earlier
+    files of that size are hashed then too if they weren't yet. Hashes are
+    read from and written to the on-disk index if there is one.
+
+    Required:
+        hasher (arg): Function returning generate_hash's tuple for a file
+        index_algorithm (arg): Name the hashes are stored under in the index
+
+    Optional:
+        cur (arg/kwarg): A cursor for a DB set up with index.setup_index
+        group_by_size (kwarg): If False, every file is hashed, as for
+                               payload_only where copies can differ in size
+    """
+
+    def __init__(self, hasher, index_algorithm, cur=None, group_by_size=True):
+        self.hasher = hasher
+        self.index_algorithm = index_algorithm
+        self.cur = cur
+        self.group_by_size = group_by_size
+        self.files = {}  # [index key, digest, order] by filepath
+        self.by_size = defaultdict(set)
+        self.by_digest = defaultdict(set)
+        self.added = 0
+
+    def __contains__(self, fpath):
+        return fpath in self.files
+
+    def unchanged(self, fpath, st):
+        """Returns True if fpath was added with the same inode, size and
+        mtime as st
+        """
+        if (entry := self.files.get(fpath)) is None:
+            return False
+        return entry[0] == index.index_key(fpath, st)
+
+    def add(self, fpath, st, digest=None):
+        self.remove(fpath)
+        self.added += 1
+        self.files[fpath] = [index.index_key(fpath, st), digest, self.added]
+        self.by_size[st.st_size].add(fpath)
+        if digest is not None:
+            self.by_digest[digest].add(fpath)
+            if self.cur is not None:
+                index.update(
+                    self.cur,
+                    self.files[fpath][0],
+                    self.index_algorithm,
+                    digest
+                )
+
+    def remove(self, fpath):
+        if (entry := self.files.pop(fpath, None)) is None:
+            return
+        key, digest, _ = entry
+        self.by_size[key[2]].discard(fpath)
+        if not self.by_size[key[2]]:
+            del self.by_size[key[2]]
+        if digest is not None:
+            self.by_digest[digest].discard(fpath)
+            if not self.by_digest[digest]:
+                del self.by_digest[digest]
+
+    def remove_tree(self, path):
+        """Removes path and every file below it"""
+        prefix = os.path.join(path, '')
+        for fpath in [
+            f for f in self.files if f == path or f.startswith(prefix)
+        ]:
+            self.remove(fpath)
+
+    def needs_hash(self, size):
+        """Returns True if a new file of size has to be hashed to tell if it
+        is unique, hashing the files of that size that weren't yet
+        """
+        if not self.group_by_size:
+            return True
+        if not (others := self.by_size.get(size)):
+            return False
+        for fpath in list(others):
+            if self.files[fpath][1] is None:
+                self.fill(fpath)
+        return True
+
+    def fill(self, fpath):
+        """Looks up or hashes the digest of a file added without one. Files
+        that can't be read any more are removed.
+        """
+        key = self.files[fpath][0]
+        digest = None
+        if self.cur is not None:
+            digest = index.lookup(self.cur, key, self.index_algorithm)
+        if digest is None:
+            _, digest, _ = self.hasher(fpath, previews=False)
+            if isinstance(digest, Exception):
+                self.remove(fpath)
+                return
+            if self.cur is not None:
+                index.update(self.cur, key, self.index_algorithm, digest)
+        self.files[fpath][1] = digest
+        self.by_digest[digest].add(fpath)
+
+    def first(self, digest):
+        """Returns the earliest added filepath with digest, else None"""
+        fpaths = self.by_digest.get(digest)
+        if not fpaths:
+            return None
+        return min(fpaths, key=lambda fpath: self.files[fpath][2])
+
+
+def process(cwd, *args, **kwargs):
+    """Iterator that yields a tuple of (match, filepath, mem), like
+    search.process, for every image in cwd and then for every image that
+    lands in it. Takes the same arguments as watch
+    """
+    for result in watch(cwd, *args, **kwargs):
+        yield result.match, result.fpath, result.mem
+
+
+def watch(
+    cwd,
+    img_types=None,
+    previews=True,
+    stats=None,
+    index_path=None,
+    algorithm='md5',
+    preview_size=None,
+    payload_only=False,
+    exclude=None,
+    settle=SETTLE,
+    quiet=QUIET,
+    poll_interval=None,
+    stop=None,
+    **find_kwargs
+):
+    """Iterator that yields a Result for every image in cwd, as find does,
+    then keeps watching cwd and yields a Result for every image created,
+    modified or moved into it until stop is set or the iterator is closed.
+
+    Changes are picked up with inotify on Linux, else by listing cwd every
+    poll_interval seconds. A file is hashed once it has been closed by its
+    writer and left alone for settle seconds, or after quiet seconds
+    without events if it is still open, and only if its size and mtime
+    held still meanwhile. New files are only hashed if another file of
+    their size has been seen, see Catalog, so a duplicate is usually
+    flagged within milliseconds of being written. Files that are removed
+    are forgotten, the Results for them are not taken back.
+
+    Optional:
+        img_types (arg/kwarg): Array object containting exention types to use
+        previews (kwarg): If False, mem is None for every Result
+        stats (kwarg): dict updated in place by the first scan, see find
+        index_path (kwarg): Filepath of an on-disk index to read and update,
+                            which keeps the hashes across restarts
+        algorithm (kwarg): Name of the hash algorithm found in ALGORITHMS
+        preview_size (kwarg): If given, mem holds a preview of this size
+        payload_only (kwarg): If True, JPEGs and PNGs are matched on their
+                              image data alone, see find
+        exclude (kwarg): Array object of glob patterns of paths to skip
+        settle (kwarg): Seconds to wait after a file is closed
+        quiet (kwarg): Seconds to wait after a write to a file left open
+        poll_interval (kwarg): If given, cwd is listed this often instead of
+                               being watched with inotify
+        stop (kwarg): A threading.Event that ends the iterator once set
+        find_kwargs (kwargs): Passed on to find for the first scan, except
+                              tree_min_bytes as tree digests are not what
+                              later files are hashed to
+    """
+    if img_types is None:
+        img_types = {'.jpg', '.jpeg', '.tiff', '.gif', '.png'}
+    if algorithm not in ALGORITHMS:
+        choices = ', '.join(ALGORITHMS)
+        raise ValueError(f'algorithm must be one of {choices}')
+    if find_kwargs.get('tree_min_bytes') is not None:
+        raise ValueError('tree_min_bytes can not be used with watch')
+    exclude = tuple(exclude or ())
+    max_depth = find_kwargs.get('max_depth')
+    follow_symlinks = find_kwargs.get('follow_symlinks', False)
+    scan_kwargs = {
+        'exclude': exclude,
+        'max_depth': max_depth,
+        'follow_symlinks': follow_symlinks,
+    }
+    recorder = metrics.recorder()
+
+    def excluded(path):
+        name = os.path.basename(path)
+        return any(
+            fnmatch(name, pattern) or fnmatch(path, pattern)
+            for pattern in exclude
+        )
+
+    def wanted(path):
+        if os.path.splitext(path)[1].lower() not in img_types:
+            return False
+        return not (exclude and excluded(path))
+
+    def hasher(fpath, previews=previews):
+        return generate_hash(
+            fpath,
+            previews=previews,
+            algorithm=algorithm,
+            preview_size=preview_size,
+            payload_only=payload_only
+        )
+
+    # Watch before the first scan so nothing written during it is missed
+    source = None
+    if poll_interval is None:
+        try:
+            source = Inotify(
+                cwd,
+                excluded if exclude else None,
+                max_depth=max_depth,
+                follow_symlinks=follow_symlinks
+            )
+        except OSError:
+            poll_interval = POLL_INTERVAL
+    con = None
+    try:
+        first_scan = find(
+            cwd,
+            img_types,
+            previews=previews,
+            stats=stats,
+            index_path=index_path,
+            algorithm=algorithm,
+            preview_size=preview_size,
+            payload_only=payload_only,
+            exclude=exclude,
+            **find_kwargs
+        )
+        if source is None:
+            # Listed first, so files written during the scan are reported
+            source = Poller(cwd, img_types, poll_interval, **scan_kwargs)
+        # find writes the first scan's hashes to the index itself, the
+        # Catalog only writes later ones, once find has closed its
+        # connection, as a second writer would be locked out
+        catalog = Catalog(
+            hasher,
+            f'{algorithm}+payload' if payload_only else algorithm,
+            group_by_size=not payload_only
+        )
+        for result in first_scan:
+            try:
+                st = os.stat(result.fpath)
+            except OSError:
+                st = None
+            if st is not None and result.error is None:
+                catalog.add(result.fpath, st, result.digest)
+            yield result
+        if index_path is not None:
+            con = sqlite3.connect(index_path)
+            catalog.cur = con.cursor()
+            index.setup_index(catalog.cur)
+        pending = {}  # [deadline, identity, first event time] by filepath
+        while stop is None or not stop.is_set():
+            now = time.monotonic()
+            timeout = WAKE_INTERVAL
+            if pending:
+                timeout = min(
+                    timeout,
+                    min(deadline for deadline, _, _ in pending.values()) - now
+                )
+            for kind, path in source.read(timeout):
+                if recorder is not None:
+                    recorder.inc('watch_events')
+                now = time.monotonic()
+                if kind == 'removed':
+                    pending.pop(path, None)
+                    catalog.remove_tree(path)
+                elif kind == 'rescan':
+                    listed = set()
+                    if max_depth is None:
+                        rescan_kwargs = scan_kwargs
+                    else:
+                        rescan_kwargs = {
+                            **scan_kwargs,
+                            'max_depth': max_depth - depth(cwd, path),
+                        }
+                    if (rescan_kwargs['max_depth'] or 0) < 0:
+                        continue
+                    for fpath, st in scan(path, img_types, **rescan_kwargs):
+                        listed.add(fpath)
+                        if st is not None and not catalog.unchanged(fpath, st):
+                            pending.setdefault(fpath, [0, None, now])[:2] = [
+                                now + settle, (st.st_size, st.st_mtime_ns)
+                            ]
+                    prefix = os.path.join(path, '')
+                    for fpath in [
+                        f for f in catalog.files
+                        if f.startswith(prefix) and f not in listed
+                    ]:
+                        catalog.remove(fpath)
+                elif wanted(path):
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue  # Gone again, its removal is on its way
+                    wait = settle if kind == 'closed' else quiet
+                    pending.setdefault(path, [0, None, now])[:2] = [
+                        now + wait, (st.st_size, st.st_mtime_ns)
+                    ]
+            now = time.monotonic()
+            for fpath in [
+                f for f, (deadline, _, _) in pending.items() if deadline <= now
+            ]:
+                _, identity, first_event = pending[fpath]
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    del pending[fpath]
+                    catalog.remove(fpath)
+                    continue
+                if (st.st_size, st.st_mtime_ns) != identity:
+                    # Check it held still for another settle
+                    pending[fpath][:2] = [
+                        now + settle, (st.st_size, st.st_mtime_ns)
+                    ]
+                    continue
+                del pending[fpath]
+                if catalog.unchanged(fpath, st):
+                    continue
+                catalog.remove(fpath)
+                if catalog.needs_hash(st.st_size):
+                    _, digest, mem = hasher(fpath)
+                    if isinstance(digest, Exception):
+                        result = Result(
+                            False, fpath, st.st_size, None, mem, str(digest)
+                        )
+                    else:
+                        original = catalog.first(digest)
+                        catalog.add(fpath, st, digest)
+                        result = Result(
+                            False if original is None else Match(original, 0),
+                            fpath,
+                            st.st_size,
+                            digest,
+                            mem
+                        )
+                else:
+                    catalog.add(fpath, st)
+                    mem = None
+                    if previews:
+                        _, mem = load_image(fpath, preview_size)
+                    result = Result(False, fpath, st.st_size, None, mem)
+                if recorder is not None:
+                    recorder.observe('watch', time.monotonic() - first_event)
+                yield result
+            if con is not None:
+                con.commit()
+    finally:
+        if source is not None:
+            source.close()
+        if con is not None:
+            con.commit()
+            con.close()
+
+
+def depth(root, path):
+    """Returns how many directories below root path is, 0 for root"""
+    relpath = os.path.relpath(path, root)
+    return 0 if relpath == os.curdir else relpath.count(os.sep) + 1
+
+
+def last_error(fpath=None):
+    """Returns an OSError for the errno left by the last libc call"""
+    code = ctypes.get_errno()
+    return OSError(code, os.strerror(code), fpath)
@@ -1,20 +1,42 @@
 import os
 import time
 import wx
-import zlib
 
 from io import BytesIO
-from threading import Thread
+from threading import Event, Lock, Thread
 
-from search import ImageQueue, process
+import metrics
+import watch
+
+from search import ImageQueue, Scanner
+from thumbnails import ThumbnailCache
+
+
+CAROUSEL_SIZE = 32  # Results waiting to be decoded before the scan blocks
+FPS = 30
+MATCH_HOLD = .5  # Seconds a match stays on screen
 
 
 class MainWindow(wx.Frame):
 
-    def __init__(self, parent):
+    def __init__(
+        self, parent, index_path=None, thumbnails=None, watching=False
+    ):
         super().__init__(parent, size=(600, 325))
-        self.resized = False
+        self.index_path = index_path
+        self.thumbnails = thumbnails
+        self.watching = watching
+        self.closing = Event()  # Ends a watch when the window is closed
+        self.scanner = Scanner()  # Keeps the pool warm across restarts
+        self.carousel_size = self.GetSize()
+        self.frame = None  # Newest decoded (is_match, wx.Image) to show
+        self.frame_lock = Lock()
+        self.processed, self.matches = 0, 0
+        self.shown_counts = None
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
         self.Bind(wx.EVT_SIZE, self.on_resize)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
         self.Show(True)
         self.carousel_panel = None
         self.results_panel = None
@@ -29,58 +51,68 @@ class MainWindow(wx.Frame):
         sizer.Add(self.select_panel, 1, wx.EXPAND)
         self.SetSizer(sizer)
         self.status_bar = self.CreateStatusBar()
-        self.image_carousel = ImageQueue()
+        self.image_carousel = ImageQueue(maxsize=CAROUSEL_SIZE)
 
     def run(self, cwd):
-        """Initiates the processing of images and sets off the carousel
+        """Initiates the processing of images and sets off the carousel.
+
+        The scan and the decoding each run on a background Thread and only
+        self.on_timer touches the widgets, at most FPS times a second.
 
         args (required):
             cwd - The starting location where the images were processed
         """
-        processed, matches = 0, 0
+        self.processed, self.matches = 0, 0
+        self.shown_counts = None
         self.status_bar.SetFieldsCount(number=3, widths=(-3, -1, -1))
-        self.status_bar.SetStatusText('Processed: 0', i=1)
-        self.status_bar.SetStatusText('Matches: 0', i=2)
-        carousel_thread = Thread(target=self.spin_the_carousel, daemon=True)
-        carousel_thread.start()
-        for is_match, fpath, mem in process(cwd):
+        self.setup_carousel_bitmaps()
+        self.carousel_size = self.GetSize()
+        Thread(target=self.scan, args=(cwd,), daemon=True).start()
+        Thread(target=self.spin_the_carousel, daemon=True).start()
+        self.timer.Start(1000 // FPS)
+        self.update_status()
+
+    def scan(self, cwd):
+        """Feeds the results of a scan of cwd to self.image_carousel, blocking
+        while it is full, and shows the results once the carousel is empty
+
+        args (required):
+            cwd - The starting location where the images were processed
+        """
+        recorder = metrics.recorder()
+        if self.watching:
+            results = watch.process(
+                cwd,
+                index_path=self.index_path,
+                executor=self.scanner.executor,
+                stop=self.closing
+            )
+        else:
+            results = self.scanner.process(cwd, index_path=self.index_path)
+        for is_match, fpath, mem in results:
             if is_match:
-                matches += 1
-                self.status_bar.SetStatusText(f'Matches: {matches:,}', i=2)
-            processed += 1
-            self.status_bar.SetStatusText(f'Processed: {processed:,}', i=1)
+                self.matches += 1
+            self.processed += 1
             self.image_carousel.put((is_match, fpath, mem))
-            wx.Yield()
+            if recorder is not None:
+                recorder.gauge('carousel_queue', self.image_carousel.qsize())
         self.image_carousel.close()
         self.image_carousel.join()
-        carousel_thread.join()
-        self.show_results(cwd, processed, matches)
+        wx.CallAfter(self.finish, cwd)
 
     def spin_the_carousel(self):
         """
-        Iterates over the self.image_carousel Queue to "spin" the carousel
+        Iterates over the self.image_carousel Queue to "spin" the carousel,
+        decoding each image for self.on_timer to show
         """
-        match_sizer, non_match_sizer = self.setup_carousel_panel()
-        match_bitmap1 = wx.StaticBitmap(self.carousel_panel)
-        match_bitmap2 = wx.StaticBitmap(self.carousel_panel)
-        non_match_bitmap = wx.StaticBitmap(self.carousel_panel)
-        match_msg = wx.StaticText(self.carousel_panel, label='Match!')
-        match_img_sizer = wx.BoxSizer(wx.HORIZONTAL)
-        match_img_sizer.Add(match_bitmap1, 1, wx.EXPAND)
-        match_img_sizer.AddSpacer(5)
-        match_img_sizer.Add(match_bitmap2, 1, wx.EXPAND)
-        match_sizer.Add(match_img_sizer, 0, wx.ALIGN_CENTER)
-        match_sizer.Add(match_msg, 0, wx.ALIGN_CENTER)
-        match_sizer.AddSpacer(25)
-        match_sizer.AddGrowableRow(0, proportion=1)
-        non_match_sizer.Add(non_match_bitmap, 1, wx.CENTER)
-        self.Layout()
-        width, height = self.GetSize()
+        recorder = metrics.recorder()
         for result in self.image_carousel:
+            if recorder is not None:
+                start = time.perf_counter()
             is_match, fpath, mem = result
-            if self.resized:
-                width, height = self.GetSize()
-                self.resized = False
+            width, height = self.carousel_size
+            if self.thumbnails is not None:
+                mem = self.thumbnails.preview(mem, (width, height))
             image = wx.Image()
             image.SetLoadFlags(0)
             if is_match:
@@ -88,24 +120,73 @@ class MainWindow(wx.Frame):
             else:
                 image.SetOption(wx.IMAGE_OPTION_MAX_WIDTH, width)
             image.SetOption(wx.IMAGE_OPTION_MAX_HEIGHT, height)
-            if image.LoadFile(BytesIO(zlib.decompress(mem))):
-                converted_image = image.ConvertToBitmap()
+            if image.LoadFile(BytesIO(mem.read())):
+                if recorder is not None:
+                    recorder.observe('render', time.perf_counter() - start)
+                with self.frame_lock:
+                    self.frame = (is_match, image)
                 if is_match:
-                    non_match_bitmap.Hide()
-                    match_bitmap1.SetBitmap(converted_image)
-                    match_bitmap1.Show()
-                    match_bitmap2.SetBitmap(converted_image)
-                    match_bitmap2.Show()
-                    match_msg.Show()
-                    self.carousel_panel.Layout()
-                    time.sleep(.5)
-                else:
-                    match_bitmap1.Hide()
-                    match_bitmap2.Hide()
-                    match_msg.Hide()
-                    non_match_bitmap.SetBitmap(converted_image)
-                    non_match_bitmap.Show()
-                    self.carousel_panel.Layout()
+                    time.sleep(MATCH_HOLD)
+
+    def on_timer(self, *event_args, **event_kwargs):
+        """Shows the newest decoded image, if any, and the progress"""
+        with self.frame_lock:
+            frame, self.frame = self.frame, None
+        self.update_status()
+        if frame is None:
+            return
+        is_match, image = frame
+        converted_image = image.ConvertToBitmap()
+        if is_match:
+            self.non_match_bitmap.Hide()
+            self.match_bitmap1.SetBitmap(converted_image)
+            self.match_bitmap1.Show()
+            self.match_bitmap2.SetBitmap(converted_image)
+            self.match_bitmap2.Show()
+            self.match_msg.Show()
+        else:
+            self.match_bitmap1.Hide()
+            self.match_bitmap2.Hide()
+            self.match_msg.Hide()
+            self.non_match_bitmap.SetBitmap(converted_image)
+            self.non_match_bitmap.Show()
+        self.carousel_panel.Layout()
+
+    def update_status(self):
+        """Updates the status bar if the counts changed since the last call"""
+        counts = (self.processed, self.matches)
+        if counts != self.shown_counts:
+            self.shown_counts = counts
+            self.status_bar.SetStatusText(f'Processed: {counts[0]:,}', i=1)
+            self.status_bar.SetStatusText(f'Matches: {counts[1]:,}', i=2)
+
+    def finish(self, cwd):
+        """Stops the carousel and shows the results
+
+        args (required):
+            cwd - The starting location where the images were processed
+        """
+        self.timer.Stop()
+        self.update_status()
+        self.show_results(cwd, self.processed, self.matches)
+
+    def setup_carousel_bitmaps(self):
+        """Creates the carousel's bitmaps in a fresh self.carousel_panel"""
+        match_sizer, non_match_sizer = self.setup_carousel_panel()
+        self.match_bitmap1 = wx.StaticBitmap(self.carousel_panel)
+        self.match_bitmap2 = wx.StaticBitmap(self.carousel_panel)
+        self.non_match_bitmap = wx.StaticBitmap(self.carousel_panel)
+        self.match_msg = wx.StaticText(self.carousel_panel, label='Match!')
+        match_img_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        match_img_sizer.Add(self.match_bitmap1, 1, wx.EXPAND)
+        match_img_sizer.AddSpacer(5)
+        match_img_sizer.Add(self.match_bitmap2, 1, wx.EXPAND)
+        match_sizer.Add(match_img_sizer, 0, wx.ALIGN_CENTER)
+        match_sizer.Add(self.match_msg, 0, wx.ALIGN_CENTER)
+        match_sizer.AddSpacer(25)
+        match_sizer.AddGrowableRow(0, proportion=1)
+        non_match_sizer.Add(self.non_match_bitmap, 1, wx.CENTER)
+        self.Layout()
 
     def setup_carousel_panel(self):
         """Creates and promotes the self.carousel_panel if needed,
@@ -251,14 +332,58 @@ class MainWindow(wx.Frame):
         self.Layout()
 
     def on_resize(self, *event_args, **event_kwargs):
-        self.resized = True
+        self.carousel_size = self.GetSize()
         self.Layout()
 
+    def on_close(self, event):
+        self.closing.set()
+        self.timer.Stop()
+        self.scanner.close()
+        event.Skip()
+
     def close(self, *args, **kwargs):
         self.Close()
 
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--index', help='Filepath of an on-disk index to reuse between scans'
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Filepath to write stage metrics to on exit, as Prometheus '
+             'text if it ends with .prom else JSON'
+    )
+    parser.add_argument(
+        '--thumbnails',
+        help='Directory of the thumbnail cache shared by the front-ends'
+    )
+    parser.add_argument(
+        '--no-thumbnails',
+        action='store_true',
+        help='Decode the original images instead of cached thumbnails'
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep watching the selected folder after the scan and show new '
+             'images as they are written'
+    )
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
     app = wx.App(False)
-    frame = MainWindow(None)
+    frame = MainWindow(
+        None,
+        index_path=args.index,
+        thumbnails=None if args.no_thumbnails else ThumbnailCache(
+            args.thumbnails
+        ),
+        watching=args.watch
+    )
     app.MainLoop()
+    if args.metrics:
+        metrics.current.write(args.metrics)